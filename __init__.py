@@ -1,3 +1,3 @@
-from .links_cluster import LinksCluster
+from .links_cluster import FrozenLinksCluster, HyperplaneLSHIndex, Instrumentation, LinksCluster
 
-__all__ = ['LinksCluster']
+__all__ = ['FrozenLinksCluster', 'HyperplaneLSHIndex', 'Instrumentation', 'LinksCluster']
@@ -0,0 +1,146 @@
+"""Asyncio front end for LinksCluster with request coalescing.
+
+Vectors submitted by concurrent callers are queued in arrival order and
+coalesced into micro-batches, which run one at a time on a worker thread.
+The event loop is never blocked by clustering.
+"""
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from links_cluster import LinksCluster
+
+
+class AsyncLinksCluster:
+    """Serve a LinksCluster to asyncio callers.
+
+    A batch is started as soon as max_batch_size vectors are waiting, or
+    once the oldest waiting vector has waited max_wait seconds. Batches run
+    strictly in arrival order, so labels are the same as calling predict in
+    the order the requests arrived.
+
+    Args:
+        model: LinksCluster
+            The model to serve. It must not be used elsewhere meanwhile.
+        max_batch_size: int
+            Largest number of vectors clustered in one batch
+        max_wait: float
+            Latency budget in seconds for filling a batch
+        n_recent: int
+            Number of recent wait times kept for percentiles
+    """
+    def __init__(self, model: LinksCluster, max_batch_size: int = 256,
+                 max_wait: float = 0.002, n_recent: int = 4096):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending = collections.deque()
+        self.dim = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='links-cluster')
+        self.worker = None
+        self.closing = False
+        self.has_pending = None
+        self.batch_full = None
+        self.n_batches = 0
+        self.n_vectors = 0
+        self.largest_batch = 0
+        self.recent_waits = collections.deque(maxlen=n_recent)
+
+    async def predict(self, vector: np.ndarray) -> int:
+        """Queue vector and wait for its cluster id.
+
+        Vectors are checked here, so a malformed one fails its own caller
+        only instead of the whole batch it would join.
+        """
+        loop = asyncio.get_running_loop()
+        if self.closing:
+            raise RuntimeError("AsyncLinksCluster is closed.")
+        vector = np.asarray(vector)
+        if vector.ndim != 1:
+            raise ValueError(f"Expected a 1-D vector, got shape {vector.shape}.")
+        if self.dim is None:
+            centroids = self.model.centroid_matrix.vectors
+            self.dim = vector.shape[0] if centroids is None else centroids.shape[1]
+        if vector.shape[0] != self.dim:
+            raise ValueError(f"Expected a vector of length {self.dim}, got {vector.shape[0]}.")
+        if self.worker is None:
+            self.has_pending = asyncio.Event()
+            self.batch_full = asyncio.Event()
+            self.worker = loop.create_task(self._run())
+        future = loop.create_future()
+        self.pending.append((vector, future, loop.time()))
+        self.has_pending.set()
+        if len(self.pending) >= self.max_batch_size:
+            self.batch_full.set()
+        return await future
+
+    async def _run(self):
+        """Form and run batches for as long as the front end is open."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.has_pending.wait()
+            if not self.pending:
+                return  # Closing and drained
+            budget = self.pending[0][2] + self.max_wait - loop.time()
+            if len(self.pending) < self.max_batch_size and budget > 0 and not self.closing:
+                self.batch_full.clear()
+                try:
+                    await asyncio.wait_for(self.batch_full.wait(), budget)
+                except asyncio.TimeoutError:
+                    pass
+            batch = [self.pending.popleft()
+                     for _ in range(min(len(self.pending), self.max_batch_size))]
+            if not self.pending and not self.closing:
+                self.has_pending.clear()
+            started = loop.time()
+            self.recent_waits.extend(started - queued for _, _, queued in batch)
+            self.n_batches += 1
+            self.n_vectors += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            try:
+                vectors = np.stack([vector for vector, _, _ in batch])
+                labels = await loop.run_in_executor(self.executor,
+                                                    self.model.predict_batch, vectors)
+            except Exception as e:  # pylint: disable=broad-except
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future, _), label in zip(batch, labels.tolist()):
+                if not future.done():
+                    future.set_result(label)
+
+    def metrics(self) -> dict:
+        """Queue depth, batch size and wait time statistics.
+
+        Wait times are seconds from a request's arrival to the start of its
+        batch, over the most recent n_recent requests.
+        """
+        waits = np.array(self.recent_waits)
+        return {
+            'queue_depth': len(self.pending),
+            'batches': self.n_batches,
+            'vectors': self.n_vectors,
+            'mean_batch_size': self.n_vectors / self.n_batches if self.n_batches else 0.0,
+            'max_batch_size': self.largest_batch,
+            'mean_wait': float(waits.mean()) if len(waits) else 0.0,
+            'p99_wait': float(np.percentile(waits, 99)) if len(waits) else 0.0,
+            'max_wait': float(waits.max()) if len(waits) else 0.0,
+        }
+
+    async def close(self):
+        """Finish the queued requests without waiting out the budget, then stop."""
+        self.closing = True
+        if self.worker is not None:
+            self.has_pending.set()
+            self.batch_full.set()
+            await self.worker
+        self.executor.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,251 @@
+"""Benchmarks of LinksCluster throughput, latency and memory.
+
+Streams are drawn from mixtures of von Mises-Fisher distributions on the
+unit sphere, whose mean directions may drift as the stream goes on. Every
+combination of thresholds and store_vectors in the suite is run on the
+same stream, and the results are written as JSON. Against a saved
+baseline, slower, larger or differently clustered results are flagged:
+
+    python links_benchmark.py --output baseline.json
+    python links_benchmark.py --baseline baseline.json --tolerance 0.2
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from links_cluster import LinksCluster
+
+DEFAULT_SUITE = {
+    'n_vectors': 5000,
+    'dim': 64,
+    'n_clusters': 10,
+    'kappa': 200.0,
+    'drift': 0.0,
+    'seed': 0,
+    'repeats': 3,
+    'thresholds': [(0.7, 0.8, 0.9), (0.5, 0.7, 0.9), (0.3, 0.6, 0.8)],
+    'store_vectors': [False, True],
+}
+
+# Metrics compared against a baseline, and whether larger values are better
+METRICS = {
+    'throughput': True,
+    'batch_throughput': True,
+    'p50_latency': False,
+    'p99_latency': False,
+    'peak_memory': False,
+}
+
+
+def sample_vmf(mean_directions: np.ndarray, kappa: float, rng) -> np.ndarray:
+    """One von Mises-Fisher sample around each row of mean_directions.
+
+    Uses Wood's rejection sampler for the component along the mean, and a
+    uniformly random direction orthogonal to it for the rest.
+    """
+    n, dim = mean_directions.shape
+    b = (dim - 1) / (2 * kappa + np.sqrt(4 * kappa ** 2 + (dim - 1) ** 2))
+    x0 = (1 - b) / (1 + b)
+    c = kappa * x0 + (dim - 1) * np.log(1 - x0 ** 2)
+    w = np.empty(n)
+    missing = np.arange(n)
+    while len(missing):
+        z = rng.beta((dim - 1) / 2, (dim - 1) / 2, size=len(missing))
+        candidates = (1 - (1 + b) * z) / (1 - (1 - b) * z)
+        accepted = kappa * candidates + (dim - 1) * np.log(1 - x0 * candidates) - c \
+            >= np.log(rng.random(len(missing)))
+        w[missing[accepted]] = candidates[accepted]
+        missing = missing[~accepted]
+    orthogonal = rng.normal(size=(n, dim))
+    orthogonal -= np.sum(orthogonal * mean_directions, axis=1, keepdims=True) * mean_directions
+    orthogonal /= np.linalg.norm(orthogonal, axis=1, keepdims=True)
+    return w[:, np.newaxis] * mean_directions + np.sqrt(1 - w ** 2)[:, np.newaxis] * orthogonal
+
+
+def vmf_mixture(n_vectors: int, dim: int, n_clusters: int, kappa: float,
+                drift: float = 0.0, seed=None) -> tuple:
+    """A stream of unit vectors from a mixture of von Mises-Fisher distributions.
+
+    Args:
+        n_vectors: int
+            Length of the stream
+        dim: int
+            Dimension of the vectors
+        n_clusters: int
+            Number of mixture components, drawn with equal probability
+        kappa: float
+            Concentration of every component, larger is tighter
+        drift: float
+            Angle in radians each mean direction turns by over the stream
+        seed:
+            Seed of the random generator
+
+    Returns:
+        tuple
+            Vectors of shape (n_vectors, dim) and their component labels
+    """
+    rng = np.random.default_rng(seed)
+    means = rng.normal(size=(n_clusters, dim))
+    means /= np.linalg.norm(means, axis=1, keepdims=True)
+    labels = rng.integers(n_clusters, size=n_vectors)
+    mean_directions = means[labels]
+    if drift:
+        # Turn each mean within the plane spanned by it and a random orthogonal direction
+        targets = rng.normal(size=(n_clusters, dim))
+        targets -= np.sum(targets * means, axis=1, keepdims=True) * means
+        targets /= np.linalg.norm(targets, axis=1, keepdims=True)
+        angles = drift * np.arange(n_vectors)[:, np.newaxis] / max(1, n_vectors - 1)
+        mean_directions = np.cos(angles) * mean_directions + np.sin(angles) * targets[labels]
+    return sample_vmf(mean_directions, kappa, rng), labels
+
+
+def run_benchmark(vectors: np.ndarray, thresholds: tuple, store_vectors: bool = False,
+                  repeats: int = 3, **cluster_kwargs) -> dict:
+    """Measure one LinksCluster configuration on vectors.
+
+    Fresh models are run predict by predict for latencies and throughput,
+    and with fit_predict for batch throughput, repeats times each, keeping
+    the fastest run to damp noise. One more run under tracemalloc gives the
+    peak memory, so tracing does not slow the timed runs.
+
+    Returns:
+        dict
+            Throughputs in vectors per second, latency percentiles in
+            seconds, peak memory in bytes, and the final subcluster and
+            cluster counts
+    """
+    latencies = None
+    batch_seconds = np.inf
+    for _ in range(repeats):
+        model = LinksCluster(*thresholds, store_vectors=store_vectors, **cluster_kwargs)
+        run_latencies = np.empty(len(vectors))
+        for i, vector in enumerate(vectors):
+            start = time.perf_counter()
+            model.predict(vector)
+            run_latencies[i] = time.perf_counter() - start
+        if latencies is None or run_latencies.sum() < latencies.sum():
+            latencies = run_latencies
+        start = time.perf_counter()
+        LinksCluster(*thresholds, store_vectors=store_vectors,
+                     **cluster_kwargs).fit_predict(vectors)
+        batch_seconds = min(batch_seconds, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        LinksCluster(*thresholds, store_vectors=store_vectors,
+                     **cluster_kwargs).fit_predict(vectors)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'thresholds': list(thresholds),
+        'store_vectors': store_vectors,
+        'throughput': len(vectors) / latencies.sum(),
+        'batch_throughput': len(vectors) / batch_seconds,
+        'p50_latency': float(np.percentile(latencies, 50)),
+        'p90_latency': float(np.percentile(latencies, 90)),
+        'p99_latency': float(np.percentile(latencies, 99)),
+        'max_latency': float(latencies.max()),
+        'peak_memory': peak_memory,
+        'n_subclusters': len(model.subclusters),
+        'n_clusters': len(model.cluster_members),
+    }
+
+
+def run_suite(suite: dict = None) -> dict:
+    """Run every configuration of suite on one vMF stream.
+
+    Args:
+        suite: dict
+            Keys of DEFAULT_SUITE to override
+
+    Returns:
+        dict
+            The suite, the platform and one result per configuration,
+            keyed by configuration name
+    """
+    suite = {**DEFAULT_SUITE, **(suite or {})}
+    vectors, _ = vmf_mixture(suite['n_vectors'], suite['dim'], suite['n_clusters'],
+                             suite['kappa'], drift=suite['drift'], seed=suite['seed'])
+    results = {}
+    for thresholds in suite['thresholds']:
+        for store_vectors in suite['store_vectors']:
+            name = '{}-{}-{}-store_vectors={}'.format(*thresholds, store_vectors)
+            results[name] = run_benchmark(vectors, tuple(thresholds), store_vectors,
+                                          repeats=suite['repeats'])
+    return {
+        'suite': suite,
+        'platform': {'python': platform.python_version(), 'numpy': np.__version__,
+                     'machine': platform.machine()},
+        'results': results,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.2) -> list:
+    """Regressions of results against baseline.
+
+    A metric regresses when it is worse than the baseline by more than the
+    fraction tolerance. Changed subcluster or cluster counts are reported
+    too, since they mean the clustering itself changed.
+
+    Returns:
+        list
+            One message per regression, empty if there are none
+    """
+    regressions = []
+    for name, base in baseline['results'].items():
+        if name not in results['results']:
+            regressions.append(f"{name}: missing")
+            continue
+        result = results['results'][name]
+        for metric, larger_is_better in METRICS.items():
+            change = result[metric] / base[metric] - 1.0 if base[metric] else 0.0
+            if (-change if larger_is_better else change) > tolerance:
+                regressions.append(f"{name}: {metric} {base[metric]:.4g} -> "
+                                   f"{result[metric]:.4g} ({change:+.1%})")
+        for count in ('n_subclusters', 'n_clusters'):
+            if result[count] != base[count]:
+                regressions.append(f"{name}: {count} {base[count]} -> {result[count]}")
+    return regressions
+
+
+def main(argv=None) -> int:
+    """Run the suite, write its results and compare them to a baseline."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    parser.add_argument('--baseline', help="Compare against results saved earlier")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Allowed fraction by which a metric may get worse")
+    for key in ('n_vectors', 'dim', 'n_clusters', 'seed', 'repeats'):
+        parser.add_argument('--' + key.replace('_', '-'), type=int, default=DEFAULT_SUITE[key])
+    for key in ('kappa', 'drift'):
+        parser.add_argument('--' + key, type=float, default=DEFAULT_SUITE[key])
+    args = parser.parse_args(argv)
+    suite = {key: getattr(args, key)
+             for key in ('n_vectors', 'dim', 'n_clusters', 'seed', 'repeats', 'kappa', 'drift')}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        # Repeat the baseline's stream and configurations
+        suite = baseline['suite']
+    results = run_suite(suite)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
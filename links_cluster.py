@@ -1,29 +1,839 @@
 """Links online clustering algorithm.
 
 Reference: https://arxiv.org/abs/1801.10123
+
+Run as python -m links_cluster to cluster vectors from a file or stdin,
+see --help.
 """
+import argparse
+import bisect
+import collections
+import cProfile
+import heapq
+import json
 import logging
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import time
+from array import array
+from operator import attrgetter
 
 import numpy as np
+from scipy import sparse
 from scipy.spatial.distance import cosine
 
+# Sparse centroids are stored dense once this fraction of entries is non-zero
+DENSE_FRACTION = 1.0 / 3.0
+
+
+def as_centroid(row):
+    """row as a sparse 1 x d matrix while sparse enough, else as a dense vector."""
+    if sparse.issparse(row) and row.nnz > DENSE_FRACTION * row.shape[1]:
+        return row.toarray().ravel()
+    return row
+
+
+def weighted_sum(a, a_weight: float, b, b_weight: float):
+    """a_weight * a + b_weight * b for dense vectors and canonical sparse rows."""
+    if sparse.issparse(a) and sparse.issparse(b):
+        return as_centroid((a * a_weight + b * b_weight).tocsr())
+    if sparse.issparse(a):
+        a, a_weight, b, b_weight = b, b_weight, a, a_weight
+    result = a * a_weight
+    if sparse.issparse(b):
+        result[b.indices] += b.data * b_weight
+    else:
+        result += b * b_weight
+    return result
+
+
+def dot(a, b) -> float:
+    """Dot product of two dense vectors or canonical sparse rows."""
+    if sparse.issparse(b):
+        a, b = b, a
+    if not sparse.issparse(a):
+        return float(a @ b)
+    if sparse.issparse(b):
+        _, a_idx, b_idx = np.intersect1d(a.indices, b.indices, assume_unique=True,
+                                         return_indices=True)
+        return float(a.data[a_idx] @ b.data[b_idx])
+    return float(a.data @ b[a.indices])
+
+
+def stack_rows(rows: list, dim: int, dtype=np.float64):
+    """CSR matrix of canonical sparse rows, empty rows for None."""
+    nnz = [0 if row is None else row.nnz for row in rows]
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(nnz, out=indptr[1:])
+    live_rows = [row for row in rows if row is not None]
+    if live_rows:
+        data = np.concatenate([row.data for row in live_rows])
+        indices = np.concatenate([row.indices for row in live_rows])
+    else:
+        data, indices = np.empty(0, dtype=dtype), np.empty(0, dtype=np.int64)
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(rows), dim))
+
+
+def find_roots(parents: np.ndarray) -> np.ndarray:
+    """Root of every node of a forest of parent pointers, by pointer jumping."""
+    while True:
+        grandparents = parents[parents]
+        if np.array_equal(grandparents, parents):
+            return parents
+        parents = grandparents
+
+
+class Instrumentation:
+    """Counters, phase timing histograms and event callbacks for a LinksCluster.
+
+    Pass an instance as LinksCluster(instrumentation=...). Without one the
+    model only pays for an `is None` check on its hot paths.
+
+    Phases are timed per call into log-spaced histograms and nest: the
+    'merge' and 'relink' time is also part of 'update_cluster'. Callbacks
+    registered with on(event, callback) are called synchronously with the
+    arguments listed in EVENTS.
+    """
+    COUNTERS = ('predictions', 'similarity_evaluations', 'merges', 'edges_added',
+                'edges_removed', 'severs', 'splits', 'new_subclusters', 'new_clusters',
+                'evictions')
+    PHASES = ('search', 'block_search', 'update_cluster', 'merge', 'relink', 'split')
+    EVENTS = {
+        'new_subcluster': '(subcluster)',
+        'new_cluster': '(cluster_id)',
+        'merge': '(survivor, merged)',
+        'edge_added': '(sc1, sc2)',
+        'edge_removed': '(sc1, sc2)',
+        'sever': '(subcluster, new_cluster_id)',
+        'split': '(cluster_id, new_cluster_id, subclusters)',
+        'evict': '(subcluster)',
+    }
+
+    def __init__(self, bucket_bounds: list = None):
+        # 100ns to 10s, four buckets per decade by default
+        self.bucket_bounds = list(bucket_bounds) if bucket_bounds is not None \
+            else [10.0 ** (e / 4) for e in range(-28, 5)]
+        self.callbacks = {event: [] for event in self.EVENTS}
+        self.reset()
+
+    def reset(self):
+        """Zero all counters and histograms, keep the callbacks."""
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.histograms = {phase: [0] * (len(self.bucket_bounds) + 1) for phase in self.PHASES}
+        self.totals = dict.fromkeys(self.PHASES, 0.0)
+        self.maxima = dict.fromkeys(self.PHASES, 0.0)
+
+    def count(self, counter: str, n: int = 1):
+        """Increase counter by n."""
+        self.counters[counter] += n
+
+    def record(self, phase: str, seconds: float):
+        """Add one timing of phase."""
+        self.histograms[phase][bisect.bisect_left(self.bucket_bounds, seconds)] += 1
+        self.totals[phase] += seconds
+        if seconds > self.maxima[phase]:
+            self.maxima[phase] = seconds
+
+    def on(self, event: str, callback):
+        """Call callback on every event."""
+        if event not in self.callbacks:
+            raise ValueError(f"Unknown event {event}, expected one of {list(self.EVENTS)}.")
+        self.callbacks[event].append(callback)
+
+    def emit(self, event: str, *args):
+        """Call the callbacks of event with args."""
+        for callback in self.callbacks[event]:
+            callback(*args)
+
+    def percentile(self, phase: str, q: float) -> float:
+        """Upper bucket bound below which q percent of the timings of phase fall."""
+        histogram = self.histograms[phase]
+        n_calls = sum(histogram)
+        if n_calls == 0:
+            return 0.0
+        seen = 0
+        for bound, n_bucket in zip(self.bucket_bounds, histogram):
+            seen += n_bucket
+            if seen >= q / 100.0 * n_calls:
+                return min(bound, self.maxima[phase])
+        return self.maxima[phase]
+
+    def summary(self) -> dict:
+        """Counters and per-phase timing statistics as plain numbers."""
+        phases = {}
+        for phase in self.PHASES:
+            n_calls = sum(self.histograms[phase])
+            if n_calls:
+                phases[phase] = {
+                    'calls': n_calls,
+                    'total': self.totals[phase],
+                    'mean': self.totals[phase] / n_calls,
+                    'p50': self.percentile(phase, 50),
+                    'p99': self.percentile(phase, 99),
+                    'max': self.maxima[phase],
+                }
+        return {'counters': dict(self.counters), 'phases': phases}
+
+
+class HyperplaneLSHIndex:
+    """Approximate nearest-centroid index using random-hyperplane LSH.
+
+    Each of n_tables hash tables buckets rows by the signs of their
+    projections onto n_bits random hyperplanes. Rows sharing a bucket with
+    the query in any table are the candidates. More tables raise recall,
+    more bits shrink buckets and speed up the search.
+    """
+    exact = False
+
+    def __init__(self, n_tables: int = 8, n_bits: int = 12, seed=None):
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.rng = np.random.default_rng(seed)
+        self.planes = None
+        self.bit_weights = 1 << np.arange(n_bits, dtype=np.int64)
+        self.tables = [{} for _ in range(n_tables)]
+        self.row_keys = {}
+
+    def _keys(self, vector: np.ndarray) -> tuple:
+        """Bucket key of vector in every table."""
+        if self.planes is None:
+            self.planes = self.rng.normal(size=(self.n_tables * self.n_bits, vector.shape[-1]))
+        bits = (self.planes @ vector > 0.0).reshape(self.n_tables, self.n_bits)
+        return tuple((bits @ self.bit_weights).tolist())
+
+    def update(self, row: int, vector: np.ndarray):
+        """Insert row or move it to the buckets of its new vector."""
+        keys = self._keys(vector)
+        old_keys = self.row_keys.get(row)
+        if old_keys == keys:
+            return
+        for table, key, old_key in zip(self.tables, keys, old_keys or keys):
+            if old_keys is not None and old_key != key:
+                table[old_key].discard(row)
+                if not table[old_key]:
+                    del table[old_key]
+            table.setdefault(key, set()).add(row)
+        self.row_keys[row] = keys
+
+    def remove(self, row: int):
+        """Drop row from every table."""
+        old_keys = self.row_keys.pop(row, None)
+        if old_keys is None:
+            return
+        for table, key in zip(self.tables, old_keys):
+            table[key].discard(row)
+            if not table[key]:
+                del table[key]
+
+    def candidates(self, vector: np.ndarray) -> np.ndarray:
+        """Sorted rows that share a bucket with vector in at least one table."""
+        rows = set()
+        for table, key in zip(self.tables, self._keys(vector)):
+            rows.update(table.get(key, ()))
+        return np.array(sorted(rows), dtype=np.int64)
+
+
+class ClusterBounds:
+    """Per-cluster angular bounds over the rows of a CentroidMatrix.
+
+    Every cluster keeps a unit center and an angular radius such that each
+    of its rows is within radius of the center. For a query at angle theta
+    to the center, no row of the cluster can be more similar than
+    cos(max(theta - radius, 0)), so whole clusters can be skipped without
+    changing the result of an exact search.
+
+    Written rows only widen the radius. The center and a tight radius are
+    recomputed from the rows once a cluster has seen as many writes as it
+    has rows, which keeps the cost amortized constant per write.
+    """
+    def __init__(self, initial_capacity: int = 16):
+        self.centers = None
+        self.radii = np.zeros(initial_capacity)
+        self.n_writes = np.zeros(initial_capacity, dtype=np.int64)
+        self.slots = {}
+        self.members = []
+        self.row_arrays = []
+        self.free_slots = []
+        self.n_slots = 0
+
+    def __len__(self):
+        return self.n_slots - len(self.free_slots)
+
+    def _slot(self, cluster_id: int, dim: int) -> int:
+        """Slot of cluster cluster_id, allocated if the cluster has none."""
+        slot = self.slots.get(cluster_id)
+        if slot is not None:
+            return slot
+        if self.free_slots:
+            slot = self.free_slots.pop()
+        else:
+            if self.centers is None:
+                self.centers = np.zeros((len(self.radii), dim))
+            if self.n_slots == len(self.radii):
+                self.centers = np.concatenate([self.centers, np.zeros_like(self.centers)])
+                self.radii = np.concatenate([self.radii, np.zeros_like(self.radii)])
+                self.n_writes = np.concatenate([self.n_writes, np.zeros_like(self.n_writes)])
+            slot = self.n_slots
+            self.n_slots += 1
+            self.members.append(None)
+            self.row_arrays.append(None)
+        self.slots[cluster_id] = slot
+        self.members[slot] = set()
+        self.radii[slot] = np.inf
+        self.n_writes[slot] = 0
+        return slot
+
+    def add(self, row: int, cluster_id: int, vectors: np.ndarray):
+        """Make row a member of cluster cluster_id."""
+        slot = self._slot(cluster_id, vectors.shape[1])
+        self.members[slot].add(row)
+        self.row_arrays[slot] = None
+        self.write(row, cluster_id, vectors)
+
+    def remove(self, row: int, cluster_id: int):
+        """Drop row from cluster cluster_id, release the cluster once it is empty."""
+        slot = self.slots[cluster_id]
+        self.members[slot].discard(row)
+        self.row_arrays[slot] = None
+        if not self.members[slot]:
+            del self.slots[cluster_id]
+            self.members[slot] = None
+            self.radii[slot] = -np.inf
+            self.free_slots.append(slot)
+
+    def write(self, row: int, cluster_id: int, vectors: np.ndarray):
+        """Widen the bound of cluster cluster_id to cover the new value of row."""
+        slot = self.slots[cluster_id]
+        self.n_writes[slot] += 1
+        if self.n_writes[slot] > len(self.members[slot]) or not np.isfinite(self.radii[slot]):
+            self.rebuild(slot, vectors)
+        else:
+            cos_angle = min(max(float(self.centers[slot] @ vectors[row]), -1.0), 1.0)
+            self.radii[slot] = max(self.radii[slot], np.arccos(cos_angle))
+
+    def rebuild(self, slot: int, vectors: np.ndarray):
+        """Recompute the center and a tight radius of slot from its rows."""
+        rows = self.rows(slot)
+        center = vectors[rows].sum(axis=0, dtype=np.float64)
+        norm = np.linalg.norm(center)
+        if norm > 0.0:
+            self.centers[slot] = center / norm
+            cos_angles = np.clip(vectors[rows] @ self.centers[slot], -1.0, 1.0)
+            self.radii[slot] = np.arccos(cos_angles.min())
+        else:
+            self.radii[slot] = np.pi
+        self.n_writes[slot] = 0
+
+    def rows(self, slot: int) -> np.ndarray:
+        """Sorted rows of the cluster in slot."""
+        if self.row_arrays[slot] is None:
+            self.row_arrays[slot] = np.array(sorted(self.members[slot]), dtype=np.int64)
+        return self.row_arrays[slot]
+
+    def upper_bounds(self, unit_vector: np.ndarray) -> np.ndarray:
+        """Highest similarity any row of each slot can have to unit_vector, -inf for free slots."""
+        cos_angles = np.clip(self.centers[:self.n_slots] @ unit_vector, -1.0, 1.0)
+        with np.errstate(invalid='ignore'):
+            bounds = np.cos(np.maximum(np.arccos(cos_angles) - self.radii[:self.n_slots], 0.0))
+        bounds[self.radii[:self.n_slots] == -np.inf] = -np.inf
+        return bounds
+
+
+class CentroidMatrix:
+    """Contiguous matrix of unit-normalized subcluster centroids.
+
+    Every registered subcluster owns one row for as long as it lives, so
+    rows never move. Rows of merged subclusters are released and reused
+    by later subclusters. Alongside the matrix the owning subcluster and
+    its cluster index are kept per row.
+
+    An optional index (such as HyperplaneLSHIndex) is kept in sync with
+    the rows and narrows nearest to a set of candidate rows. With
+    cluster_bounds, exact searches skip clusters whose ClusterBounds prove
+    they cannot hold the nearest row.
+    """
+    def __init__(self, initial_capacity: int = 64, index=None, dtype=None,
+                 cluster_bounds: bool = False):
+        self.index = index
+        self.bounds = ClusterBounds() if cluster_bounds else None
+        self.dtype = dtype
+        self.vectors = None
+        self.cluster_ids = np.zeros(initial_capacity, dtype=np.int64)
+        self.subclusters = []
+        self.free_rows = []
+        self.n_rows = 0
+        self.changed_rows = None
+        self.last_n_evaluated = 0
+
+    def __len__(self):
+        return self.n_rows - len(self.free_rows)
+
+    def _grow(self, centroid: np.ndarray):
+        """Make room for at least one more row shaped like centroid."""
+        capacity = len(self.cluster_ids)
+        if self.vectors is None:
+            centroid = np.asarray(centroid)
+            dtype = self.dtype or np.result_type(centroid.dtype, np.float32)
+            self.vectors = np.zeros((capacity, centroid.shape[-1]), dtype=dtype)
+        if self.n_rows < capacity:
+            return
+        vectors = np.zeros((2 * capacity, self.vectors.shape[1]), dtype=self.vectors.dtype)
+        vectors[:capacity] = self.vectors
+        self.vectors = vectors
+        cluster_ids = np.zeros(2 * capacity, dtype=np.int64)
+        cluster_ids[:capacity] = self.cluster_ids
+        self.cluster_ids = cluster_ids
+
+    def add(self, subcluster: 'Subcluster', cluster_id: int) -> int:
+        """Register subcluster as a member of cluster cluster_id, return its row."""
+        if self.free_rows:
+            row = self.free_rows.pop()
+            self.subclusters[row] = subcluster
+        else:
+            self._grow(subcluster.centroid)
+            row = self.n_rows
+            self.n_rows += 1
+            self.subclusters.append(subcluster)
+        self.cluster_ids[row] = cluster_id
+        if self.changed_rows is not None:
+            self.changed_rows.add(row)
+        subcluster.centroid_matrix = self
+        subcluster.matrix_row = row
+        self.write(row, subcluster.centroid)
+        if self.bounds is not None:
+            self.bounds.add(row, cluster_id, self.vectors)
+        return row
+
+    def move(self, row: int, cluster_id: int):
+        """Make row a member of cluster cluster_id."""
+        if self.bounds is not None:
+            self.bounds.remove(row, self.cluster_ids[row])
+            self.bounds.add(row, cluster_id, self.vectors)
+        self.cluster_ids[row] = cluster_id
+
+    def update(self, row: int, centroid: np.ndarray):
+        """Overwrite row with the normalized centroid."""
+        self.write(row, centroid)
+        if self.bounds is not None:
+            self.bounds.write(row, self.cluster_ids[row], self.vectors)
+
+    def write(self, row: int, centroid: np.ndarray):
+        """Store the normalized centroid in row, keep the index in sync."""
+        if self.changed_rows is not None:
+            self.changed_rows.add(row)
+        norm = np.linalg.norm(centroid)
+        if norm > 0.0:
+            np.divide(centroid, norm, out=self.vectors[row], casting='unsafe')
+        else:
+            self.vectors[row] = 0.0
+        if self.index is not None:
+            self.index.update(row, self.vectors[row])
+
+    def remove(self, subcluster: 'Subcluster'):
+        """Release the row of subcluster."""
+        row = subcluster.matrix_row
+        if subcluster.centroid_matrix is not self or row is None:
+            return
+        if self.bounds is not None:
+            self.bounds.remove(row, self.cluster_ids[row])
+        self.subclusters[row] = None
+        self._clear(row)
+        self.free_rows.append(row)
+        if self.index is not None:
+            self.index.remove(row)
+        if self.changed_rows is not None:
+            self.changed_rows.add(row)
+        subcluster.centroid_matrix = None
+        subcluster.matrix_row = None
+
+    def _clear(self, row: int):
+        """Zero a released row."""
+        self.vectors[row] = 0.0
+
+    def similarities(self, vector: np.ndarray) -> np.ndarray:
+        """Cosine similarity of vector to every row, -inf for released rows."""
+        norm = np.linalg.norm(vector)
+        sims = self.vectors[:self.n_rows] @ vector
+        if norm > 0.0:
+            sims /= norm
+        if self.free_rows:
+            sims[self.free_rows] = -np.inf
+        return sims
+
+    def nearest(self, vector: np.ndarray, exact: bool = False) -> int:
+        """Row of the centroid most similar to vector.
+
+        Only the candidates of the index are compared, unless exact is True
+        or the index has no candidates.
+        """
+        if self.index is not None and not exact:
+            rows = self.index.candidates(vector)
+            if len(rows):
+                self.last_n_evaluated = len(rows)
+                return int(rows[np.argmax(self.vectors[rows] @ vector)])
+        if self.bounds is not None:
+            return self.nearest_pruned(vector)
+        self.last_n_evaluated = len(self)
+        return int(np.argmax(self.similarities(vector)))
+
+    def nearest_pruned(self, vector: np.ndarray) -> int:
+        """Exact nearest row, visiting clusters by decreasing upper bound.
+
+        The search stops at the first cluster whose bound is below the best
+        similarity found so far. Bounds are widened by a slack covering the
+        rounding error of the angles, so the result is that of a full scan.
+        """
+        norm = np.linalg.norm(vector)
+        if norm == 0.0:
+            self.last_n_evaluated = len(self)
+            return int(np.argmax(self.similarities(vector)))
+        unit_vector = vector / norm
+        bounds = self.bounds.upper_bounds(unit_vector)
+        slack = 4.0 * np.sqrt(np.finfo(self.vectors.dtype).eps)
+        best_row, best_similarity = -1, -np.inf
+        self.last_n_evaluated = len(self.bounds)
+        for slot in np.argsort(-bounds, kind='stable').tolist():
+            if bounds[slot] + slack < best_similarity or bounds[slot] == -np.inf:
+                break
+            rows = self.bounds.rows(slot)
+            sims = self.vectors[rows] @ unit_vector
+            self.last_n_evaluated += len(rows)
+            i = int(np.argmax(sims))
+            if sims[i] > best_similarity or (sims[i] == best_similarity and rows[i] < best_row):
+                best_row, best_similarity = int(rows[i]), sims[i]
+        return best_row
+
+    def row_similarities(self, rows: list, vector: np.ndarray) -> np.ndarray:
+        """Cosine similarity of vector to the given live rows."""
+        norm = np.linalg.norm(vector)
+        sims = self.vectors[rows] @ vector
+        if norm > 0.0:
+            sims /= norm
+        return sims
+
+    def block_similarities(self, vectors: np.ndarray) -> np.ndarray:
+        """Cosine similarity of each of vectors to every row, shape (len(vectors), n_rows)."""
+        norms = np.linalg.norm(vectors, axis=1)
+        norms[norms == 0.0] = 1.0
+        sims = vectors @ self.vectors[:self.n_rows].T
+        sims /= norms[:, np.newaxis]
+        if self.free_rows:
+            sims[:, self.free_rows] = -np.inf
+        return sims
+
+    def track_changes(self) -> set:
+        """Start recording rows written from now on, return the (empty) record."""
+        self.changed_rows = set()
+        return self.changed_rows
+
+    def stop_tracking(self):
+        """Stop recording written rows."""
+        self.changed_rows = None
+
+
+class SparseCentroidMatrix(CentroidMatrix):
+    """CentroidMatrix keeping unit-normalized centroids as sparse rows.
+
+    Similarities are sparse-sparse products with a CSR stack of the rows.
+    Rows written since the stack was built are scored one by one, and the
+    stack is rebuilt once they make up an eighth of the matrix.
+    """
+    def __init__(self, initial_capacity: int = 64, dtype=None):
+        super().__init__(initial_capacity, dtype=dtype)
+        self.rows = []
+        self.stack = None
+        self.stale_rows = set()
+        self.dim = None
+
+    def _grow(self, centroid):
+        """Make room for at least one more row."""
+        self.dim = centroid.shape[-1]
+        capacity = len(self.cluster_ids)
+        if self.n_rows == capacity:
+            cluster_ids = np.zeros(2 * capacity, dtype=np.int64)
+            cluster_ids[:capacity] = self.cluster_ids
+            self.cluster_ids = cluster_ids
+        self.rows.append(None)
+
+    def write(self, row: int, centroid):
+        """Store the normalized centroid in row as a sparse row."""
+        if self.changed_rows is not None:
+            self.changed_rows.add(row)
+        dtype = self.dtype or np.float64
+        centroid = sparse.csr_matrix(centroid.reshape(1, -1) if not sparse.issparse(centroid)
+                                     else centroid, dtype=dtype)
+        norm = np.sqrt(centroid.data @ centroid.data)
+        if norm > 0.0:
+            centroid = centroid / norm
+        self.rows[row] = centroid
+        self.stale_rows.add(row)
+
+    def _clear(self, row: int):
+        """Drop a released row."""
+        self.rows[row] = None
+        self.stale_rows.add(row)
+
+    def _build_stack(self):
+        """Stack every row into one CSR matrix."""
+        self.stack = stack_rows(self.rows[:self.n_rows], self.dim, self.dtype)
+        self.stale_rows = set()
+
+    def similarities(self, vector) -> np.ndarray:
+        """Cosine similarity of the sparse row vector to every row, -inf for released rows."""
+        if len(self.stale_rows) > max(16, self.n_rows // 8):
+            self._build_stack()
+        sims = np.zeros(self.n_rows)
+        n_stacked = 0 if self.stack is None else self.stack.shape[0]
+        if n_stacked:
+            sims[:n_stacked] = (self.stack @ vector.T).toarray().ravel()
+        stale_rows = sorted(self.stale_rows.union(range(n_stacked, self.n_rows)))
+        live_rows = [row for row in stale_rows if self.rows[row] is not None]
+        if live_rows:
+            sims[live_rows] = self.row_similarities(live_rows, vector, normalize=False)
+        norm = np.sqrt(dot(vector, vector))
+        if norm > 0.0:
+            sims /= norm
+        if self.free_rows:
+            sims[self.free_rows] = -np.inf
+        return sims
+
+    def nearest(self, vector, exact: bool = False) -> int:
+        """Row of the centroid most similar to the sparse row vector."""
+        self.last_n_evaluated = len(self)
+        return int(np.argmax(self.similarities(vector)))
+
+    def row_similarities(self, rows: list, vector, normalize: bool = True) -> np.ndarray:
+        """Cosine similarity of the sparse row vector to the given live rows."""
+        sims = (stack_rows([self.rows[row] for row in rows], self.dim, self.dtype)
+                @ vector.T).toarray().ravel()
+        norm = np.sqrt(dot(vector, vector))
+        if normalize and norm > 0.0:
+            sims /= norm
+        return sims
+
+    def block_similarities(self, vectors) -> np.ndarray:
+        """Cosine similarity of each sparse row of vectors to every row."""
+        if self.stale_rows or self.stack is None or self.stack.shape[0] < self.n_rows:
+            self._build_stack()
+        norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+        norms[norms == 0.0] = 1.0
+        sims = (vectors @ self.stack.T).toarray()
+        sims /= norms[:, np.newaxis]
+        if self.free_rows:
+            sims[:, self.free_rows] = -np.inf
+        return sims
+
+
+class VectorArena:
+    """Append-only storage for input vectors.
+
+    Vectors are copied into chunks that double in size up to chunk_size
+    rows, and are addressed by their integer position in arrival order.
+    With spill_dir, chunks are memory-mapped .npy files in a directory of
+    their own inside spill_dir, so arenas can share spill_dir.
+    """
+    def __init__(self, chunk_size: int = 65536, spill_dir: str = None):
+        self.chunk_size = chunk_size
+        self.spill_dir = spill_dir
+        self.spill_path = None
+        self.chunks = []
+        self.chunk_starts = []
+        self.n_vectors = 0
+
+    @classmethod
+    def from_array(cls, vectors: np.ndarray, **kwargs) -> 'VectorArena':
+        """Arena whose first chunk is vectors, without copying them."""
+        arena = cls(**kwargs)
+        if len(vectors):
+            arena.chunks.append(vectors)
+            arena.chunk_starts.append(0)
+            arena.n_vectors = len(vectors)
+        return arena
+
+    def __len__(self):
+        return self.n_vectors
+
+    def _new_chunk(self, vector: np.ndarray):
+        """Start a chunk shaped for vector."""
+        if self.chunks:
+            capacity = min(2 * len(self.chunks[-1]), self.chunk_size)
+        else:
+            capacity = min(16, self.chunk_size)
+        shape = (capacity,) + vector.shape
+        if self.spill_dir is None:
+            chunk = np.empty(shape, dtype=vector.dtype)
+        else:
+            if self.spill_path is None:
+                os.makedirs(self.spill_dir, exist_ok=True)
+                self.spill_path = tempfile.mkdtemp(prefix='arena-', dir=self.spill_dir)
+            filename = os.path.join(self.spill_path, f'chunk_{len(self.chunks)}.npy')
+            chunk = np.lib.format.open_memmap(filename, mode='w+', dtype=vector.dtype,
+                                              shape=shape)
+        self.chunks.append(chunk)
+        self.chunk_starts.append(self.n_vectors)
+
+    def append(self, vector: np.ndarray) -> int:
+        """Copy vector into the arena, return its id."""
+        if not self.chunks or \
+                self.n_vectors - self.chunk_starts[-1] == len(self.chunks[-1]):
+            self._new_chunk(vector)
+        vector_id = self.n_vectors
+        self.chunks[-1][vector_id - self.chunk_starts[-1]] = vector
+        self.n_vectors += 1
+        return vector_id
+
+    def take(self, vector_ids) -> np.ndarray:
+        """Stacked array of the vectors with ids vector_ids."""
+        vector_ids = np.asarray(vector_ids, dtype=np.int64)
+        if not self.chunks:
+            return np.empty((0, 0))
+        chunk_idx = np.searchsorted(self.chunk_starts, vector_ids, side='right') - 1
+        if len(vector_ids) and chunk_idx[0] == chunk_idx[-1] and \
+                (chunk_idx == chunk_idx[0]).all():
+            return self.chunks[chunk_idx[0]][vector_ids - self.chunk_starts[chunk_idx[0]]]
+        vectors = np.empty((len(vector_ids),) + self.chunks[0].shape[1:],
+                           dtype=self.chunks[0].dtype)
+        for i in np.unique(chunk_idx):
+            in_chunk = chunk_idx == i
+            vectors[in_chunk] = self.chunks[i][vector_ids[in_chunk] - self.chunk_starts[i]]
+        return vectors
+
+    def view(self) -> np.ndarray:
+        """All vectors in arrival order, a view if they fit in one chunk."""
+        if not self.chunks:
+            return np.empty((0, 0))
+        if len(self.chunks) == 1:
+            return self.chunks[0][:self.n_vectors]
+        return np.concatenate(self.chunks)[:self.n_vectors]
+
+
+class SparseVectorArena:
+    """Append-only storage for sparse input vectors.
+
+    The vectors are the rows of one CSR matrix whose parts grow by
+    doubling, and are addressed by their position in arrival order.
+    """
+    def __init__(self, dtype=np.float64):
+        self.data = np.empty(1024, dtype=dtype)
+        self.indices = np.empty(1024, dtype=np.int64)
+        self.indptr = [0]
+        self.dim = 0
+
+    @classmethod
+    def from_csr(cls, vectors) -> 'SparseVectorArena':
+        """Arena holding the rows of the CSR matrix vectors."""
+        arena = cls(dtype=vectors.dtype)
+        arena.data = vectors.data
+        arena.indices = vectors.indices
+        arena.indptr = vectors.indptr.tolist()
+        arena.dim = vectors.shape[1]
+        return arena
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def append(self, vector) -> int:
+        """Copy the sparse row vector into the arena, return its id."""
+        start = self.indptr[-1]
+        end = start + vector.nnz
+        if end > len(self.data) or not self.data.flags.writeable:
+            # Also copies out of a read-only snapshot on the first append
+            capacity = max(2 * len(self.data), end, 1024)
+            self.data = np.resize(self.data, capacity)
+            self.indices = np.resize(self.indices, capacity)
+        self.data[start:end] = vector.data
+        self.indices[start:end] = vector.indices
+        self.indptr.append(end)
+        self.dim = vector.shape[1]
+        return len(self.indptr) - 2
+
+    def take(self, vector_ids):
+        """CSR matrix of the vectors with ids vector_ids."""
+        return self.view()[np.asarray(vector_ids, dtype=np.int64)]
+
+    def view(self):
+        """CSR matrix of all vectors in arrival order, sharing the arena's memory."""
+        end = self.indptr[-1]
+        return sparse.csr_matrix((self.data[:end], self.indices[:end], self.indptr),
+                                 shape=(len(self), self.dim))
+
 
 class Subcluster:
-    """Class for subclusters and edges between subclusters."""
-    def __init__(self, initial_vector: np.ndarray, store_vectors: bool = False):
-        self.input_vectors = [initial_vector]
-        self.centroid = initial_vector
+    """Class for subclusters and edges between subclusters.
+
+    With store_vectors, input vectors are kept in a VectorArena (shared by
+    all subclusters of a model) and the subcluster only holds their ids.
+
+    With compensated, the centroid is updated with Kahan-compensated
+    arithmetic. The rounding error is carried in self.compensation, so
+    low-precision centroids don't drift over long streams.
+
+    Sparse input vectors are 1 x d CSR matrices. Their centroid stays
+    sparse until more than DENSE_FRACTION of its entries are non-zero, and
+    is a dense vector from then on.
+    """
+    def __init__(self, initial_vector: np.ndarray, store_vectors: bool = False,
+                 arena: VectorArena = None, compensated: bool = False):
+        self.subcluster_id = None
+        self.cluster_id = None
+        self.centroid_matrix = None
+        self.matrix_row = None
+        self.vector_ids = array('q')
+        self.arena = None
+        if store_vectors:
+            if arena is None:
+                arena = SparseVectorArena(initial_vector.dtype) \
+                    if sparse.issparse(initial_vector) else VectorArena(chunk_size=1024)
+            self.arena = arena
+            self.vector_ids.append(self.arena.append(initial_vector))
+        self.centroid = as_centroid(initial_vector)
+        self.compensation = np.zeros_like(initial_vector) if compensated else None
         self.n_vectors = 1
         self.store_vectors = store_vectors
         self.connected_subclusters = set()
+        self.last_update = 0
+        self.log_weight = 0.0
+
+    @property
+    def input_vectors(self) -> np.ndarray:
+        """Stacked array of the stored vectors of the subcluster."""
+        if self.arena is None:
+            if sparse.issparse(self.centroid):
+                return sparse.csr_matrix((0, self.centroid.shape[1]))
+            return np.empty((0,) + np.shape(self.centroid))
+        return self.arena.take(np.frombuffer(self.vector_ids, dtype=np.int64))
+
+    @property
+    def centroid(self) -> np.ndarray:
+        """Mean of the vectors in the subcluster."""
+        return self._centroid
+
+    @centroid.setter
+    def centroid(self, value: np.ndarray):
+        self._centroid = value
+        if self.centroid_matrix is not None:
+            self.centroid_matrix.update(self.matrix_row, value)
 
     def add(self, vector: np.ndarray):
         """Add a new vector to the subcluster, update the centroid."""
         if self.store_vectors:
-            self.input_vectors.append(vector)
+            self.vector_ids.append(self.arena.append(vector))
         self.n_vectors += 1
         if self.centroid is None:
             self.centroid = vector
+        elif sparse.issparse(vector) or sparse.issparse(self.centroid):
+            self.centroid = weighted_sum(self.centroid, (self.n_vectors - 1) / self.n_vectors,
+                                         vector, 1.0 / self.n_vectors)
+        elif self.compensation is not None:
+            # The exact mean is centroid - compensation
+            step = (vector - (self.centroid - self.compensation)) / self.n_vectors \
+                - self.compensation
+            centroid = self.centroid + step
+            self.compensation = (centroid - self.centroid) - step
+            self.centroid = centroid
         else:
             self.centroid = (self.n_vectors - 1) / \
                             self.n_vectors * self.centroid \
@@ -34,14 +844,37 @@ class Subcluster:
               delete_merged: bool = True):
         """Merge subcluster_merge into self. Update centroids."""
         if self.store_vectors:
-            self.input_vectors += subcluster_merge.input_vectors
+            if subcluster_merge.arena is self.arena:
+                self.vector_ids.extend(subcluster_merge.vector_ids)
+            else:
+                for vector in subcluster_merge.input_vectors:
+                    self.vector_ids.append(self.arena.append(vector))
 
         # Update centroid and n_vectors
-        self.centroid = self.n_vectors * self.centroid \
-            + subcluster_merge.n_vectors \
-            * subcluster_merge.centroid
-        self.centroid /= self.n_vectors + subcluster_merge.n_vectors
+        if self.compensation is not None:
+            # Weighted mean of the exact centroids in float64, keep the rounding error
+            merge_compensation = subcluster_merge.compensation \
+                if subcluster_merge.compensation is not None else 0.0
+            exact = self.n_vectors * (self.centroid - self.compensation.astype(np.float64)) \
+                + subcluster_merge.n_vectors \
+                * (subcluster_merge.centroid - np.asarray(merge_compensation, np.float64))
+            exact /= self.n_vectors + subcluster_merge.n_vectors
+            centroid = exact.astype(self.centroid.dtype)
+            self.compensation = (centroid - exact).astype(self.centroid.dtype)
+        elif sparse.issparse(self.centroid) or sparse.issparse(subcluster_merge.centroid):
+            n_vectors = self.n_vectors + subcluster_merge.n_vectors
+            centroid = weighted_sum(self.centroid, self.n_vectors / n_vectors,
+                                    subcluster_merge.centroid,
+                                    subcluster_merge.n_vectors / n_vectors)
+        else:
+            centroid = self.n_vectors * self.centroid \
+                + subcluster_merge.n_vectors \
+                * subcluster_merge.centroid
+            centroid /= self.n_vectors + subcluster_merge.n_vectors
+        self.centroid = centroid
         self.n_vectors += subcluster_merge.n_vectors
+        self.last_update = max(self.last_update, subcluster_merge.last_update)
+        self.log_weight = float(np.logaddexp(self.log_weight, subcluster_merge.log_weight))
         try:
             subcluster_merge.connected_subclusters.remove(self)
             self.connected_subclusters.remove(subcluster_merge)
@@ -57,62 +890,762 @@ class Subcluster:
             del subcluster_merge
 
 
+class FrozenLinksCluster:
+    """Read-only classifier of vectors into the clusters of a LinksCluster.
+
+    Made by LinksCluster.freeze, or opened from a snapshot by load. It holds
+    the centroids grouped by cluster, and classifying never changes them, so
+    any number of threads may classify at once. NumPy releases the GIL in
+    the matrix products, so threads run in parallel.
+
+    Args:
+        centroids:
+            Centroids, an array or a CSR matrix
+        cluster_ids: np.ndarray
+            Cluster id of every centroid
+        subcluster_ids: np.ndarray
+            Subcluster id of every centroid
+        norms: np.ndarray
+            Norm of every centroid, None when they are unit-normalized
+    """
+    def __init__(self, centroids, cluster_ids: np.ndarray, subcluster_ids: np.ndarray,
+                 norms: np.ndarray = None):
+        cluster_ids = np.asarray(cluster_ids)
+        subcluster_ids = np.asarray(subcluster_ids)
+        if np.any(cluster_ids[1:] < cluster_ids[:-1]):
+            order = np.lexsort((subcluster_ids, cluster_ids))
+            centroids, cluster_ids, subcluster_ids = \
+                centroids[order], cluster_ids[order], subcluster_ids[order]
+            norms = None if norms is None else norms[order]
+        # Otherwise already grouped by cluster, the arrays are used as they are
+        self.centroids = centroids
+        self.cluster_ids = cluster_ids
+        self.subcluster_ids = subcluster_ids
+        self.norms = None if norms is None else np.where(norms == 0.0, 1.0, norms)
+        self.sparse_input = sparse.issparse(centroids)
+        is_start = np.ones(len(self.cluster_ids), dtype=bool)
+        is_start[1:] = self.cluster_ids[1:] != self.cluster_ids[:-1]
+        self.cluster_starts = np.flatnonzero(is_start)
+        self.clusters = self.cluster_ids[self.cluster_starts]
+        for values in (self.centroids.data if self.sparse_input else self.centroids,
+                       self.cluster_ids, self.subcluster_ids,
+                       self.cluster_starts, self.clusters):
+            values.flags.writeable = False
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'FrozenLinksCluster':
+        """Open a snapshot written by LinksCluster.save as a read-only classifier.
+
+        Unlike LinksCluster.load, no subclusters or edges are rebuilt. With
+        mmap, the centroids and ids are used in place from the snapshot
+        files, so opening costs the same for any number of subclusters.
+        """
+        mmap_mode = 'r' if mmap else None
+
+        def load_array(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+
+        with open(os.path.join(path, 'state.json'), encoding='utf-8') as f:
+            state = json.load(f)
+        cluster_ids = load_array('cluster_ids')
+        if not len(cluster_ids):
+            return cls(np.empty((0, 0)), cluster_ids, load_array('subcluster_ids'))
+        if state.get('sparse_input', False):
+            centroids = sparse.csr_matrix((load_array('centroids_data'),
+                                           load_array('centroids_indices'),
+                                           load_array('centroids_indptr')),
+                                          shape=(len(cluster_ids), state['dim']))
+        else:
+            centroids = load_array('centroids')
+        if os.path.exists(os.path.join(path, 'centroid_norms.npy')):
+            norms = load_array('centroid_norms')
+        elif sparse.issparse(centroids):
+            norms = np.sqrt(np.asarray(centroids.multiply(centroids).sum(axis=1)).ravel())
+        else:
+            norms = np.linalg.norm(centroids, axis=1)
+        return cls(centroids, cluster_ids, load_array('subcluster_ids'), norms)
+
+    def __len__(self):
+        return len(self.clusters)
+
+    def similarities(self, vectors) -> np.ndarray:
+        """Cosine similarity of every row of vectors to every centroid."""
+        if self.sparse_input:
+            vectors = sparse.csr_matrix(vectors)
+            norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+            sims = (vectors @ self.centroids.T).toarray()
+        else:
+            vectors = np.asarray(vectors)
+            norms = np.linalg.norm(vectors, axis=1)
+            sims = vectors @ self.centroids.T
+        norms[norms == 0.0] = 1.0
+        sims /= norms[:, np.newaxis]
+        if self.norms is not None:
+            sims /= self.norms
+        return sims
+
+    def _check(self, vectors):
+        """Refuse empty models and anything but 2-D input."""
+        if len(self.cluster_ids) == 0:
+            raise ValueError("The model had no clusters when it was frozen.")
+        if not sparse.issparse(vectors) and np.ndim(vectors) != 2:
+            raise ValueError(f"Expected a 2-D array, got shape {np.shape(vectors)}.")
+
+    def classify(self, vectors, chunk_size: int = 4096) -> np.ndarray:
+        """Id of the cluster of the most similar centroid, for every row of vectors."""
+        self._check(vectors)
+        labels = np.empty(vectors.shape[0], dtype=np.int64)
+        for start in range(0, vectors.shape[0], chunk_size):
+            sims = self.similarities(vectors[start:start + chunk_size])
+            labels[start:start + chunk_size] = self.cluster_ids[np.argmax(sims, axis=1)]
+        return labels
+
+    def classify_topk(self, vectors, k: int, chunk_size: int = 4096) -> tuple:
+        """The k most similar clusters of every row of vectors.
+
+        A cluster is as similar as its most similar centroid.
+
+        Args:
+            vectors:
+                Array or CSR matrix of shape (n, d)
+            k: int
+                Number of clusters per vector, at most the number of clusters
+
+        Returns:
+            tuple
+                Cluster ids and their similarities, both of shape (n, k)
+                and ordered from the most similar cluster
+        """
+        self._check(vectors)
+        k = min(k, len(self.clusters))
+        n_vectors = vectors.shape[0]
+        labels = np.empty((n_vectors, k), dtype=np.int64)
+        similarities = np.empty((n_vectors, k))
+        for start in range(0, n_vectors, chunk_size):
+            sims = self.similarities(vectors[start:start + chunk_size])
+            cluster_sims = np.maximum.reduceat(sims, self.cluster_starts, axis=1)
+            top = np.argpartition(-cluster_sims, k - 1, axis=1)[:, :k]
+            top_sims = np.take_along_axis(cluster_sims, top, axis=1)
+            order = np.argsort(-top_sims, axis=1, kind='stable')
+            labels[start:start + chunk_size] = self.clusters[np.take_along_axis(top, order, 1)]
+            similarities[start:start + chunk_size] = np.take_along_axis(top_sims, order, 1)
+        return labels, similarities
+
+
 class LinksCluster:
-    """An online clustering algorithm."""
+    """An online clustering algorithm.
+
+    Subclusters and clusters carry stable integer ids that never change
+    while they exist. Cluster ids are the labels returned by predict.
+
+    Memory can be bounded with max_subclusters and max_age. Time is counted
+    in predictions. Subclusters older than max_age predictions are evicted,
+    and while there are more than max_subclusters the one with the smallest
+    eviction key goes first:
+
+    - 'lru': least recently updated
+    - 'smallest': fewest vectors, least recently updated among equals
+    - 'decay': smallest weight, where every vector adds 1 to the weight of
+      its subcluster and weights decay by exp(-decay_rate) per prediction
+
+    Subclusters updated by the current prediction are never evicted. An
+    evicted subcluster takes its edges with it, and neighbours left without
+    edges are relinked within their cluster or moved to a new one. Only the
+    subclusters are bounded: with store_vectors the arena, and with
+    track_labels point_subclusters, still grow by every vector, including
+    the vectors of evicted subclusters.
+
+    With sparse_input, vectors may be scipy.sparse rows and batches (dense
+    ones are converted) and are never densified. Centroids are kept sparse
+    or dense by their density, and stored vectors stay sparse.
+
+    Every cluster is a connected component of the subcluster edge graph.
+    When removed edges disconnect a cluster, searches from the cut edges
+    run in step, and the part they finish last keeps the cluster id. This
+    is usually, but not always, the largest part. The other parts become
+    new clusters. With track_labels, the subcluster of every prediction is
+    recorded, and point_labels gives the current cluster id of every vector
+    seen so far.
+    """
+    # Eviction keys must not decrease while a subcluster is updated
+    EVICTION_KEYS = {
+        'lru': attrgetter('last_update'),
+        'smallest': attrgetter('n_vectors', 'last_update'),
+        'decay': attrgetter('log_weight'),
+    }
+
     def __init__(self,
                  cluster_similarity_threshold: float,
                  subcluster_similarity_threshold: float,
                  pair_similarity_maximum: float,
-                 store_vectors=False
+                 store_vectors=False,
+                 index=None,
+                 spill_dir=None,
+                 dtype=np.float64,
+                 instrumentation=None,
+                 max_subclusters: int = None,
+                 max_age: int = None,
+                 eviction: str = 'lru',
+                 decay_rate: float = 1e-3,
+                 cluster_pruning: bool = False,
+                 sparse_input: bool = False,
+                 track_labels: bool = False
                  ):
-        self.clusters = []
+        if eviction not in self.EVICTION_KEYS:
+            raise ValueError(f"Unknown eviction policy {eviction}, "
+                             f"expected one of {list(self.EVICTION_KEYS)}.")
+        if max_subclusters is not None and max_subclusters < 1:
+            raise ValueError("max_subclusters must be at least 1.")
+        if max_age is not None and max_age < 0:
+            raise ValueError("max_age must not be negative.")
+        if sparse_input and (index is not None or cluster_pruning or spill_dir is not None):
+            raise ValueError("Sparse input supports neither an index, cluster pruning "
+                             "nor spill_dir.")
+        self.sparse_input = sparse_input
+        self.max_subclusters = max_subclusters
+        self.max_age = max_age
+        self.eviction = eviction
+        self.decay_rate = decay_rate
+        self.clock = 0
+        self.eviction_heap = []
+        self.age_heap = []
+        self.split_endpoints = []
+        self.merged_into = {}
+        self.track_labels = track_labels
+        self.point_subclusters = array('q') if track_labels else None
+        self.subcluster_parents = array('q') if track_labels else None
+        self.dtype = np.dtype(dtype)
+        self.instrumentation = instrumentation
+        self.subclusters = {}
+        self.cluster_members = {}
+        self.next_subcluster_id = 0
+        self.next_cluster_id = 0
+        self.cluster_pruning = cluster_pruning
+        if sparse_input:
+            self.centroid_matrix = SparseCentroidMatrix(dtype=self.dtype)
+        else:
+            self.centroid_matrix = CentroidMatrix(index=index, dtype=self.dtype,
+                                                  cluster_bounds=cluster_pruning)
         self.cluster_similarity_threshold = cluster_similarity_threshold
         self.subcluster_similarity_threshold = subcluster_similarity_threshold
         self.pair_similarity_maximum = pair_similarity_maximum
         self.store_vectors = store_vectors
+        self.vector_arena = None
+        if store_vectors:
+            self.vector_arena = SparseVectorArena(self.dtype) if sparse_input \
+                else VectorArena(spill_dir=spill_dir)
+
+    @property
+    def clusters(self) -> list:
+        """Lists of the subclusters of every cluster, in cluster id order."""
+        return [list(members.values()) for members in self.cluster_members.values()]
+
+    @property
+    def compensated(self) -> bool:
+        """Whether centroids use compensated updates, True below float64 precision."""
+        return self.dtype.itemsize < 8 and not self.sparse_input
+
+    @property
+    def bounded(self) -> bool:
+        """Whether subclusters are evicted."""
+        return self.max_subclusters is not None or self.max_age is not None
+
+    def _as_input(self, vectors):
+        """vectors in the dtype of the model, as a CSR matrix with sparse_input."""
+        if not self.sparse_input:
+            if sparse.issparse(vectors):
+                raise TypeError("Sparse vectors need a model created with sparse_input=True.")
+            return np.asarray(vectors, dtype=self.dtype)
+        vectors = sparse.csr_matrix(vectors, dtype=self.dtype)
+        vectors.sum_duplicates()
+        return vectors
 
     def predict(self, new_vector: np.ndarray) -> int:
         """Predict a cluster id for new_vector."""
-        if len(self.clusters) == 0:
+        new_vector = self._as_input(new_vector)
+        if self.sparse_input and new_vector.shape[0] != 1:
+            raise ValueError(f"Expected a single row, got shape {new_vector.shape}.")
+        if len(self.subclusters) == 0:
             # Handle first vector
-            self.clusters.append([Subcluster(new_vector, store_vectors=self.store_vectors)])
-            return 0
-
-        best_subcluster = None
-        best_similarity = -np.inf
-        best_subcluster_cluster_id = None
-        best_subcluster_id = None
-        for cl_idx, cl in enumerate(self.clusters):
-            for sc_idx, sc in enumerate(cl):
-                cossim = 1.0 - cosine(new_vector, sc.centroid)
-                if cossim > best_similarity:
-                    best_subcluster = sc
-                    best_similarity = cossim
-                    best_subcluster_cluster_id = cl_idx
-                    best_subcluster_id = sc_idx
+            self.clock += 1
+            if self.instrumentation is not None:
+                self.instrumentation.count('predictions')
+            subcluster = self._new_subcluster(new_vector, self._new_cluster())
+            if self.track_labels:
+                self.point_subclusters.append(subcluster.subcluster_id)
+            return subcluster.cluster_id
+
+        inst = self.instrumentation
+        if inst is None:
+            return self._assign(new_vector, self.centroid_matrix.nearest(new_vector))
+        start = time.perf_counter()
+        best_row = self.centroid_matrix.nearest(new_vector)
+        inst.record('search', time.perf_counter() - start)
+        inst.count('similarity_evaluations', self.centroid_matrix.last_n_evaluated)
+        return self._assign(new_vector, best_row)
+
+    def predict_batch(self, vectors: np.ndarray, chunk_size: int = 256,
+                      max_changed_rows: int = 64) -> np.ndarray:
+        """Predict cluster ids for the rows of vectors, in order.
+
+        The labels are the same as calling predict on each row in turn, but
+        each chunk is scored against all centroids with one matrix product.
+        Centroid rows written while the chunk is consumed are rescored per
+        vector, and once more than max_changed_rows of them pile up the rest
+        of the chunk is scored again.
+
+        Args:
+            vectors: np.ndarray
+                Array of shape (n, d)
+            chunk_size: int
+                Number of vectors scored together
+            max_changed_rows: int
+                Number of stale centroid rows tolerated before rescoring
+
+        Returns:
+            np.ndarray
+                Integer cluster ids of shape (n,)
+        """
+        vectors = self._as_input(vectors)
+        if vectors.ndim != 2:
+            raise ValueError(f"Expected a 2-D array, got shape {vectors.shape}.")
+        matrix = self.centroid_matrix
+        if matrix.index is not None and not matrix.index.exact:
+            # Approximate searches are per vector, block scores don't apply
+            return np.array([self.predict(vector) for vector in vectors], dtype=np.int64)
+        labels = np.empty(vectors.shape[0], dtype=np.int64)
+        inst = self.instrumentation
+        try:
+            for start in range(0, vectors.shape[0], chunk_size):
+                chunk = vectors[start:start + chunk_size]
+                scores = None
+                changed_rows = set()
+                for i, vector in enumerate(chunk):
+                    if len(self.subclusters) == 0:
+                        labels[start + i] = self.predict(vector)
+                        continue
+                    if scores is None or len(changed_rows) > max_changed_rows:
+                        if inst is not None:
+                            block_start = time.perf_counter()
+                        scores = matrix.block_similarities(chunk[i:])
+                        scored_from = i
+                        changed_rows = matrix.track_changes()
+                        if inst is not None:
+                            inst.record('block_search', time.perf_counter() - block_start)
+                            inst.count('similarity_evaluations', scores.size)
+                    sims = scores[i - scored_from]
+                    if changed_rows:
+                        sims = self._rescore(vector, sims, changed_rows)
+                        if inst is not None:
+                            inst.count('similarity_evaluations', len(changed_rows))
+                    labels[start + i] = self._assign(vector, int(np.argmax(sims)))
+        finally:
+            matrix.stop_tracking()
+        return labels
+
+    def fit_predict(self, vectors: np.ndarray, **kwargs) -> np.ndarray:
+        """Feed the rows of vectors to the model in order, return their cluster ids.
+
+        The model is online, so this continues from its current state and
+        is equivalent to predict_batch.
+        """
+        return self.predict_batch(vectors, **kwargs)
+
+    @staticmethod
+    def _stream_chunks(source, chunk_size: int, start: int):
+        """Chunks of at most chunk_size rows of source, skipping the first start rows."""
+        if isinstance(source, (str, os.PathLike)):
+            source = np.load(source, mmap_mode='r')
+        if isinstance(source, np.ndarray) or sparse.issparse(source):
+            for chunk_start in range(start, source.shape[0], chunk_size):
+                yield source[chunk_start:chunk_start + chunk_size]
+            return
+        pending = []
+        to_skip = start
+        for item in source:
+            if sparse.issparse(item) or np.ndim(item) == 2:
+                if pending:
+                    yield np.stack(pending)
+                    pending = []
+                if to_skip >= item.shape[0]:
+                    to_skip -= item.shape[0]
+                    continue
+                for chunk_start in range(to_skip, item.shape[0], chunk_size):
+                    yield item[chunk_start:chunk_start + chunk_size]
+                to_skip = 0
+            elif to_skip:
+                to_skip -= 1
+            else:
+                pending.append(item)
+                if len(pending) == chunk_size:
+                    yield np.stack(pending)
+                    pending = []
+        if pending:
+            yield np.stack(pending)
+
+    def iter_stream(self, source, chunk_size: int = 65536, start: int = 0,
+                    checkpoint_dir: str = None, checkpoint_every: int = None,
+                    progress=None, on_checkpoint=None):
+        """Feed source to the model chunk by chunk, yield the labels of every chunk.
+
+        Only one chunk of vectors is held in memory at a time, and the
+        labels are the same as calling predict on every vector in order.
+
+        Args:
+            source:
+                Path of a .npy file (memory-mapped), an array or sparse
+                matrix, or an iterable of vectors and 2-D arrays
+            chunk_size: int
+                Largest number of vectors clustered in one batch
+            start: int
+                Number of leading vectors of source to skip, such as the
+                position returned by from_checkpoint
+            checkpoint_dir: str
+                Directory for resumable checkpoints
+            checkpoint_every: int
+                Write a checkpoint after at least this many vectors
+            progress:
+                Called after every chunk with the number of vectors done
+                (counted from the start of source), the total if known, and
+                the throughput in vectors per second
+            on_checkpoint:
+                Called with the position of every checkpoint before it is
+                written, for example to flush outputs
+
+        Yields:
+            np.ndarray
+                Integer cluster ids of each chunk
+        """
+        if checkpoint_every is not None and checkpoint_dir is None:
+            raise ValueError("checkpoint_every needs a checkpoint_dir.")
+        if isinstance(source, (str, os.PathLike)):
+            source = np.load(source, mmap_mode='r')
+        n_total = source.shape[0] if isinstance(source, np.ndarray) \
+            or sparse.issparse(source) else None
+        n_done = start
+        last_checkpoint = start
+        started = time.perf_counter()
+        for chunk in self._stream_chunks(source, chunk_size, start):
+            labels = self.predict_batch(chunk)
+            n_done += len(labels)
+            yield labels
+            if checkpoint_every is not None and n_done - last_checkpoint >= checkpoint_every:
+                if on_checkpoint is not None:
+                    on_checkpoint(n_done)
+                self.checkpoint(checkpoint_dir, n_done)
+                last_checkpoint = n_done
+            if progress is not None:
+                elapsed = time.perf_counter() - started
+                progress(n_done, n_total, (n_done - start) / elapsed if elapsed > 0 else 0.0)
+
+    def fit_stream(self, source, chunk_size: int = 65536, output=None, start: int = 0,
+                   **kwargs) -> np.ndarray:
+        """Cluster a dataset that need not fit in memory, return or write its labels.
+
+        A thin driver over iter_stream, see there for the remaining
+        arguments. Checkpoints flush output first, so a run restored with
+        from_checkpoint and restarted at its position continues the same
+        output file.
+
+        Args:
+            source:
+                Path of a .npy file (memory-mapped), an array or sparse
+                matrix, or an iterable of vectors and 2-D arrays
+            chunk_size: int
+                Largest number of vectors clustered in one batch
+            output:
+                Path of a .npy file or an array to write the labels to.
+                The file is created, or reopened when start > 0. A path
+                needs a source of known length, a file or an array.
+            start: int
+                Number of leading vectors of source to skip
+
+        Returns:
+            np.ndarray
+                output (memory-mapped for a path), or the labels of the
+                processed vectors when there is no output
+        """
+        if isinstance(source, (str, os.PathLike)):
+            source = np.load(source, mmap_mode='r')
+        if isinstance(output, (str, os.PathLike)):
+            if not isinstance(source, np.ndarray) and not sparse.issparse(source):
+                raise ValueError("Writing labels to a path needs a source of known length, "
+                                 "pass an array as output or collect the returned labels.")
+            if start > 0:
+                output = np.load(output, mmap_mode='r+')
+            else:
+                output = np.lib.format.open_memmap(output, mode='w+', dtype=np.int64,
+                                                   shape=(source.shape[0],))
+        collected = []
+        position = start
+        flush = getattr(output, 'flush', None)
+        callback = kwargs.pop('on_checkpoint', None)
+
+        def on_checkpoint(checkpoint_position):
+            if flush is not None:
+                flush()
+            if callback is not None:
+                callback(checkpoint_position)
+
+        for labels in self.iter_stream(source, chunk_size, start=start,
+                                       on_checkpoint=on_checkpoint, **kwargs):
+            if output is None:
+                collected.append(labels)
+            else:
+                output[position:position + len(labels)] = labels
+            position += len(labels)
+        if output is None:
+            return np.concatenate(collected) if collected else np.empty(0, dtype=np.int64)
+        if flush is not None:
+            flush()
+        return output
+
+    def checkpoint(self, checkpoint_dir: str, position: int):
+        """Save the model as the checkpoint of stream position position.
+
+        Each checkpoint is a fresh snapshot directory. stream.json is switched
+        to it atomically before older snapshots are removed, so a crash at any
+        point leaves the previous checkpoint intact.
+        """
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        snapshot = f'model-{position:015d}'
+        self.save(os.path.join(checkpoint_dir, snapshot))
+        filename = os.path.join(checkpoint_dir, 'stream.json')
+        with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'position': position, 'snapshot': snapshot}, f)
+        os.replace(filename + '.tmp', filename)
+        for name in os.listdir(checkpoint_dir):
+            if name.startswith('model-') and name != snapshot:
+                shutil.rmtree(os.path.join(checkpoint_dir, name), ignore_errors=True)
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint_dir: str, **kwargs) -> tuple:
+        """Restore the latest checkpoint in checkpoint_dir.
+
+        Args:
+            checkpoint_dir: str
+                Directory written by checkpoint (or fit_stream)
+            **kwargs:
+                Further arguments of load
+
+        Returns:
+            tuple
+                The restored model and the stream position to restart at
+        """
+        with open(os.path.join(checkpoint_dir, 'stream.json'), encoding='utf-8') as f:
+            stream = json.load(f)
+        kwargs.setdefault('mmap', False)
+        model = cls.load(os.path.join(checkpoint_dir, stream['snapshot']), **kwargs)
+        return model, stream['position']
+
+    def index_agreement(self, vectors: np.ndarray) -> float:
+        """Fraction of vectors for which the index and an exact scan agree on the cluster.
+
+        The model is not changed, so this can be run on held-out vectors at
+        any time to tune the index.
+
+        Args:
+            vectors: np.ndarray
+                Array of shape (n, d)
+
+        Returns:
+            float
+                Label agreement between the indexed and the exhaustive search
+        """
+        matrix = self.centroid_matrix
+        if len(vectors) == 0 or len(matrix) == 0:
+            return 1.0
+        agreed = 0
+        for vector in vectors:
+            approximate_row = matrix.nearest(vector)
+            exact_row = matrix.nearest(vector, exact=True)
+            agreed += matrix.cluster_ids[approximate_row] == matrix.cluster_ids[exact_row]
+        return agreed / len(vectors)
+
+    def _rescore(self, vector: np.ndarray, sims: np.ndarray, changed_rows: set) -> np.ndarray:
+        """Patch block similarities of vector for rows written after scoring."""
+        matrix = self.centroid_matrix
+        patched = np.full(matrix.n_rows, -np.inf)
+        patched[:len(sims)] = sims
+        rows = sorted(changed_rows)
+        patched[rows] = -np.inf
+        rows = [row for row in rows if matrix.subclusters[row] is not None]
+        if rows:
+            patched[rows] = matrix.row_similarities(rows, vector)
+        return patched
+
+    def _assign(self, new_vector: np.ndarray, best_row: int) -> int:
+        """Assign new_vector given the matrix row of its most similar centroid."""
+        self.clock += 1
+        inst = self.instrumentation
+        if inst is not None:
+            inst.count('predictions')
+        best_subcluster = self.centroid_matrix.subclusters[best_row]
+        best_similarity = self._cosine_similarity(new_vector, best_subcluster.centroid)
         if best_similarity >= self.subcluster_similarity_threshold:  # eq. (20)
             # Add to existing subcluster
             best_subcluster.add(new_vector)
-            self.update_cluster(best_subcluster_cluster_id, best_subcluster_id)
-            assigned_cluster = best_subcluster_cluster_id
+            if self.bounded:
+                self._touch(best_subcluster)
+            if inst is None:
+                self._update_cluster(best_subcluster)
+            else:
+                start = time.perf_counter()
+                self._update_cluster(best_subcluster)
+                inst.record('update_cluster', time.perf_counter() - start)
+            assigned_subcluster = best_subcluster
         else:
             # Create new subcluster
-            new_subcluster = Subcluster(new_vector, store_vectors=self.store_vectors)
-            cossim = 1.0 - cosine(new_subcluster.centroid, best_subcluster.centroid)
-            if cossim >= self.sim_threshold(best_subcluster.n_vectors, 1):  # eq. (21)
+            if best_similarity >= self.sim_threshold(best_subcluster.n_vectors, 1):  # eq. (21)
                 # New subcluster is part of existing cluster
+                new_subcluster = self._new_subcluster(new_vector, best_subcluster.cluster_id)
                 self.add_edge(best_subcluster, new_subcluster)
-                self.clusters[best_subcluster_cluster_id].append(new_subcluster)
-                assigned_cluster = best_subcluster_cluster_id
             else:
                 # New subcluster is a new cluster
-                self.clusters.append([new_subcluster])
-                assigned_cluster = len(self.clusters) - 1
-        return assigned_cluster
+                new_subcluster = self._new_subcluster(new_vector, self._new_cluster())
+            assigned_subcluster = new_subcluster
+        if self.bounded:
+            self._evict()
+        self._split_pending()
+        if self.track_labels:
+            self.point_subclusters.append(assigned_subcluster.subcluster_id)
+        return assigned_subcluster.cluster_id
 
-    @staticmethod
-    def add_edge(sc1: Subcluster, sc2: Subcluster):
+    def _new_cluster(self) -> int:
+        """Register a new, empty cluster and return its id."""
+        cluster_id = self.next_cluster_id
+        self.next_cluster_id += 1
+        self.cluster_members[cluster_id] = {}
+        if self.instrumentation is not None:
+            self.instrumentation.count('new_clusters')
+            self.instrumentation.emit('new_cluster', cluster_id)
+        return cluster_id
+
+    def _new_subcluster(self, vector: np.ndarray, cluster_id: int) -> Subcluster:
+        """Create a subcluster for vector and register it with cluster cluster_id."""
+        # The centroid starts as a copy, callers may reuse the buffer of vector
+        subcluster = Subcluster(vector.copy(), store_vectors=self.store_vectors,
+                                arena=self.vector_arena, compensated=self.compensated)
+        subcluster.last_update = self.clock
+        subcluster.log_weight = self.decay_rate * self.clock
+        return self._register_subcluster(subcluster, cluster_id)
+
+    def _register_subcluster(self, subcluster: Subcluster, cluster_id: int) -> Subcluster:
+        """Give subcluster a new id and make it a member of cluster cluster_id."""
+        subcluster.subcluster_id = self.next_subcluster_id
+        self.next_subcluster_id += 1
+        if self.track_labels:
+            self.subcluster_parents.append(subcluster.subcluster_id)
+        self.subclusters[subcluster.subcluster_id] = subcluster
+        subcluster.cluster_id = cluster_id
+        self.cluster_members[cluster_id][subcluster.subcluster_id] = subcluster
+        self.centroid_matrix.add(subcluster, cluster_id)
+        if self.bounded:
+            self._push(subcluster)
+        if self.instrumentation is not None:
+            self.instrumentation.count('new_subclusters')
+            self.instrumentation.emit('new_subcluster', subcluster)
+        return subcluster
+
+    def _remove_subcluster(self, subcluster: Subcluster):
+        """Unregister subcluster from its cluster and the centroid matrix."""
+        del self.subclusters[subcluster.subcluster_id]
+        del self.cluster_members[subcluster.cluster_id][subcluster.subcluster_id]
+        self.centroid_matrix.remove(subcluster)
+
+    def _move_subcluster(self, subcluster: Subcluster, cluster_id: int):
+        """Move subcluster to the cluster with id cluster_id."""
+        del self.cluster_members[subcluster.cluster_id][subcluster.subcluster_id]
+        self.cluster_members[cluster_id][subcluster.subcluster_id] = subcluster
+        subcluster.cluster_id = cluster_id
+        self.centroid_matrix.move(subcluster.matrix_row, cluster_id)
+
+    def _join_clusters(self, cluster_id1: int, cluster_id2: int) -> int:
+        """Move the members of the smaller cluster into the larger one, return its id."""
+        if len(self.cluster_members[cluster_id1]) < len(self.cluster_members[cluster_id2]):
+            cluster_id1, cluster_id2 = cluster_id2, cluster_id1
+        for subcluster in list(self.cluster_members[cluster_id2].values()):
+            self._move_subcluster(subcluster, cluster_id1)
+        del self.cluster_members[cluster_id2]
+        return cluster_id1
+
+    def _touch(self, subcluster: Subcluster):
+        """Record that one vector was added to subcluster now."""
+        subcluster.last_update = self.clock
+        subcluster.log_weight = float(np.logaddexp(subcluster.log_weight,
+                                                   self.decay_rate * self.clock))
+        self._push(subcluster)
+
+    def _push(self, subcluster: Subcluster):
+        """Queue the current eviction keys of subcluster.
+
+        Entries are never updated in place. An entry whose key no longer
+        matches its subcluster is stale and skipped when popped, and the
+        heaps are rebuilt once stale entries outnumber live ones.
+        """
+        if self.max_subclusters is not None:
+            heapq.heappush(self.eviction_heap, (self.EVICTION_KEYS[self.eviction](subcluster),
+                                                subcluster.subcluster_id))
+        if self.max_age is not None:
+            heapq.heappush(self.age_heap, (subcluster.last_update, subcluster.subcluster_id))
+        if len(self.eviction_heap) + len(self.age_heap) > 4 * len(self.subclusters) + 64:
+            self._rebuild_heaps()
+
+    def _rebuild_heaps(self):
+        """Rebuild the eviction heaps from the live subclusters."""
+        key = self.EVICTION_KEYS[self.eviction]
+        self.eviction_heap = [(key(sc), sc_id) for sc_id, sc in self.subclusters.items()] \
+            if self.max_subclusters is not None else []
+        self.age_heap = [(sc.last_update, sc_id) for sc_id, sc in self.subclusters.items()] \
+            if self.max_age is not None else []
+        heapq.heapify(self.eviction_heap)
+        heapq.heapify(self.age_heap)
+
+    def _evict(self):
+        """Evict subclusters past max_age, then down to max_subclusters."""
+        if self.max_age is not None:
+            heap = self.age_heap
+            while heap and heap[0][0] < self.clock - self.max_age:
+                last_update, sc_id = heapq.heappop(heap)
+                sc = self.subclusters.get(sc_id)
+                if sc is not None and sc.last_update == last_update:
+                    self._evict_subcluster(sc)
+        if self.max_subclusters is not None:
+            key = self.EVICTION_KEYS[self.eviction]
+            heap = self.eviction_heap
+            kept = []
+            while len(self.subclusters) > self.max_subclusters and heap:
+                entry = heapq.heappop(heap)
+                sc = self.subclusters.get(entry[1])
+                if sc is None or key(sc) != entry[0]:
+                    continue
+                if sc.last_update == self.clock:
+                    kept.append(entry)
+                else:
+                    self._evict_subcluster(sc)
+            for entry in kept:
+                heapq.heappush(heap, entry)
+
+    def _evict_subcluster(self, subcluster: Subcluster):
+        """Drop subcluster with its edges, relink the neighbours it leaves without edges."""
+        inst = self.instrumentation
+        neighbours = sorted(subcluster.connected_subclusters, key=lambda sc: sc.subcluster_id)
+        for neighbour in neighbours:
+            self._remove_edge(subcluster, neighbour)
+        self._remove_subcluster(subcluster)
+        if not self.cluster_members[subcluster.cluster_id]:
+            del self.cluster_members[subcluster.cluster_id]
+        if inst is not None:
+            inst.count('evictions')
+            inst.emit('evict', subcluster)
+        self._relink(neighbours)
+        self.split_endpoints.extend(neighbours)
+
+    def add_edge(self, sc1: Subcluster, sc2: Subcluster):
         """Add an edge between subclusters sc1, and sc2."""
+        if self.instrumentation is not None and sc2 not in sc1.connected_subclusters:
+            self.instrumentation.count('edges_added')
+            self.instrumentation.emit('edge_added', sc1, sc2)
         sc1.connected_subclusters.add(sc2)
         sc2.connected_subclusters.add(sc1)
 
@@ -130,88 +1663,323 @@ class LinksCluster:
                 True if the edge is valid
                 False if the edge is not valid
         """
-        cossim = 1.0 - cosine(sc1.centroid, sc2.centroid)
+        cossim = self._cosine_similarity(sc1.centroid, sc2.centroid)
         threshold = self.sim_threshold(sc1.n_vectors, sc2.n_vectors)
         if cossim < threshold:
-            try:
-                sc1.connected_subclusters.remove(sc2)
-                sc2.connected_subclusters.remove(sc1)
-            except KeyError:
-                logging.warning("Attempted to update an invalid edge that didn't exist. "
-                                "Edge remains nonexistant.")
+            self._remove_edge(sc1, sc2)
             return False
         else:
-            sc1.connected_subclusters.add(sc2)
-            sc2.connected_subclusters.add(sc1)
+            self.add_edge(sc1, sc2)
             return True
 
+    def _remove_edge(self, sc1: Subcluster, sc2: Subcluster):
+        """Remove the edge between subclusters sc1 and sc2."""
+        try:
+            sc1.connected_subclusters.remove(sc2)
+            sc2.connected_subclusters.remove(sc1)
+        except KeyError:
+            logging.warning("Attempted to update an invalid edge that didn't exist. "
+                            "Edge remains nonexistant.")
+        else:
+            if self.instrumentation is not None:
+                self.instrumentation.count('edges_removed')
+                self.instrumentation.emit('edge_removed', sc1, sc2)
+
+    @staticmethod
+    def _cosine_similarity(u, v) -> float:
+        """Cosine similarity of two dense vectors or sparse rows."""
+        if not sparse.issparse(u) and not sparse.issparse(v):
+            return 1.0 - cosine(u, v)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            similarity = dot(u, v) / np.sqrt(dot(u, u) * dot(v, v))
+        return 1.0 - min(max(1.0 - similarity, 0.0), 2.0)
+
+    @staticmethod
+    def _cosine_similarities(vector: np.ndarray, subclusters: list) -> np.ndarray:
+        """Cosine similarity of vector to the centroid of each subcluster.
+
+        Computed in float64 with the same formula and clipping as
+        1 - scipy.spatial.distance.cosine, nan for zero vectors. Sparse
+        centroids are compared one by one.
+        """
+        if sparse.issparse(vector) or any(sparse.issparse(sc.centroid) for sc in subclusters):
+            return np.array([LinksCluster._cosine_similarity(vector, sc.centroid)
+                             for sc in subclusters])
+        centroids = np.array([sc.centroid for sc in subclusters], dtype=np.float64)
+        vector = np.asarray(vector, dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sims = centroids @ vector / np.sqrt(
+                np.einsum('ij,ij->i', centroids, centroids) * (vector @ vector))
+        return 1.0 - np.clip(1.0 - sims, 0.0, 2.0)
+
     def merge_subclusters(self, cl_idx, sc_idx1, sc_idx2):
-        """Merge subclusters with id's sc_idx1 and sc_idx2 of cluster with id cl_idx."""
-        sc2 = self.clusters[cl_idx][sc_idx2]
-        self.clusters[cl_idx][sc_idx1].merge(sc2)
-        self.update_cluster(cl_idx, sc_idx1)
-        self.clusters[cl_idx] = self.clusters[cl_idx][:sc_idx2] \
-            + self.clusters[cl_idx][sc_idx2 + 1:]
-        for sc in self.clusters[cl_idx]:
-            if sc2 in sc.connected_subclusters:
-                sc.connected_subclusters.remove(sc2)
+        """Merge subclusters at positions sc_idx1 and sc_idx2 of the cluster with id cl_idx."""
+        members = list(self.cluster_members[cl_idx].values())
+        self._merge_subclusters(members[sc_idx1], members[sc_idx2])
+        self._split_pending()
+
+    def _merge_subclusters(self, sc1: Subcluster, sc2: Subcluster):
+        """Merge sc2 into sc1, unregister sc2 and update the cluster around sc1."""
+        inst = self.instrumentation
+        if inst is not None:
+            start = time.perf_counter()
+            inst.count('merges')
+            inst.emit('merge', sc1, sc2)
+        sc1.merge(sc2)
+        self.merged_into[sc2] = sc1
+        if self.track_labels:
+            self.subcluster_parents[sc2.subcluster_id] = sc1.subcluster_id
+        self._remove_subcluster(sc2)
+        if self.bounded:
+            self._push(sc1)
+        self._update_cluster(sc1)
+        if inst is not None:
+            inst.record('merge', time.perf_counter() - start)
 
     def update_cluster(self, cl_idx: int, sc_idx: int):
         """Update cluster
 
-        Subcluster with id sc_idx has been changed, and we want to
+        Subcluster at position sc_idx has been changed, and we want to
         update the parent cluster according to the discussion in
         section 3.4 of the paper.
 
         Args:
             cl_idx: int
-                The index of the cluster to update
+                The id of the cluster to update
             sc_idx: int
-                The index of the subcluster that has been changed
+                The position of the changed subcluster in the cluster
 
         Returns:
             None
 
         """
-        updated_sc = self.clusters[cl_idx][sc_idx]
+        self._update_cluster(list(self.cluster_members[cl_idx].values())[sc_idx])
+        self._split_pending()
+
+    def _update_cluster(self, updated_sc: Subcluster):
+        """Update the cluster of updated_sc after updated_sc has changed.
+
+        Only the edges of updated_sc are visited, in subcluster id order.
+        Neighbours that a nested update merged away or disconnected are
+        skipped. The similarities and edge thresholds of all neighbours are
+        computed at once, and again for the remaining ones after a merge
+        has moved the centroid of updated_sc.
+        """
+        inst = self.instrumentation
         severed_subclusters = []
-        connected_scs = set(updated_sc.connected_subclusters)
-        for connected_sc in connected_scs:
-            connected_sc_idx = None
-            for c_sc_idx, sc in enumerate(self.clusters[cl_idx]):
-                if sc == connected_sc:
-                    connected_sc_idx = c_sc_idx
-            if connected_sc_idx is None:
-                raise ValueError(f"Connected subcluster of {sc_idx} "
-                                 f"was not found in cluster list of {cl_idx}.")
-            cossim = 1.0 - cosine(updated_sc.centroid, connected_sc.centroid)
-            if cossim >= self.subcluster_similarity_threshold:
-                self.merge_subclusters(cl_idx, sc_idx, connected_sc_idx)
-            else:
-                are_connected = self.update_edge(updated_sc, connected_sc)
-                if not are_connected:
-                    severed_subclusters.append(connected_sc_idx)
-        for severed_sc_id in severed_subclusters:
-            severed_sc = self.clusters[cl_idx][severed_sc_id]
-            if len(severed_sc.connected_subclusters) == 0:
-                for cluster_sc in self.clusters[cl_idx]:
-                    if cluster_sc != severed_sc:
-                        cossim = 1.0 - cosine(cluster_sc.centroid,
-                                              severed_sc.centroid)
-                        if cossim >= self.sim_threshold(cluster_sc.n_vectors,
-                                                        severed_sc.n_vectors):
-                            self.add_edge(cluster_sc, severed_sc)
+        connected_scs = sorted(updated_sc.connected_subclusters,
+                               key=lambda sc: sc.subcluster_id)
+        sims = None
+        for i, connected_sc in enumerate(connected_scs):
+            if connected_sc not in updated_sc.connected_subclusters:
+                continue
+            if sims is None:
+                remaining = connected_scs[i:]
+                sims = self._cosine_similarities(updated_sc.centroid, remaining)
+                thresholds = self.sim_threshold(
+                    updated_sc.n_vectors, np.array([sc.n_vectors for sc in remaining]))
+                scored_from = i
+                if inst is not None:
+                    inst.count('similarity_evaluations', len(remaining))
+            if sims[i - scored_from] >= self.subcluster_similarity_threshold:
+                self._merge_subclusters(updated_sc, connected_sc)
+                sims = None
+            elif sims[i - scored_from] < thresholds[i - scored_from]:
+                self._remove_edge(updated_sc, connected_sc)
+                severed_subclusters.append(connected_sc)
+        self._relink(severed_subclusters)
+        if severed_subclusters:
+            self.split_endpoints.append(updated_sc)
+            self.split_endpoints.extend(severed_subclusters)
+
+    def _relink(self, severed_subclusters: list):
+        """Relink subclusters that lost edges, or move them to new clusters.
+
+        A severed subcluster left without edges is linked to every member of
+        its cluster close enough to it. If there is none it becomes a
+        cluster of its own.
+        """
+        inst = self.instrumentation
+        if inst is not None and severed_subclusters:
+            start = time.perf_counter()
+        for severed_sc in severed_subclusters:
+            if severed_sc.subcluster_id not in self.subclusters:
+                continue
             if len(severed_sc.connected_subclusters) == 0:
-                self.clusters[cl_idx] = self.clusters[cl_idx][:severed_sc_id] \
-                    + self.clusters[cl_idx][severed_sc_id + 1:]
-                self.clusters.append([severed_sc])
+                cluster_scs = [cluster_sc for cluster_sc
+                               in self.cluster_members[severed_sc.cluster_id].values()
+                               if cluster_sc is not severed_sc]
+                if cluster_scs:
+                    if inst is not None:
+                        inst.count('similarity_evaluations', len(cluster_scs))
+                    sims = self._cosine_similarities(severed_sc.centroid, cluster_scs)
+                    thresholds = self.sim_threshold(
+                        np.array([cluster_sc.n_vectors for cluster_sc in cluster_scs]),
+                        severed_sc.n_vectors)
+                    for j in np.flatnonzero(sims >= thresholds):
+                        self.add_edge(cluster_scs[j], severed_sc)
+            if len(severed_sc.connected_subclusters) == 0 \
+                    and len(self.cluster_members[severed_sc.cluster_id]) > 1:
+                new_cluster_id = self._new_cluster()
+                self._move_subcluster(severed_sc, new_cluster_id)
+                if inst is not None:
+                    inst.count('severs')
+                    inst.emit('sever', severed_sc, new_cluster_id)
+        if inst is not None and severed_subclusters:
+            inst.record('relink', time.perf_counter() - start)
+
+    def _split_pending(self):
+        """Split the clusters disconnected since the last call.
+
+        Endpoints of removed edges are collected through a whole cascade of
+        updates, merges and evictions, and checked once at its end. By then
+        an endpoint may have been merged away, its survivor stands in.
+        """
+        endpoints = []
+        for sc in self.split_endpoints:
+            while sc in self.merged_into:
+                sc = self.merged_into[sc]
+            endpoints.append(sc)
+        self.split_endpoints = []
+        self.merged_into = {}
+        if endpoints:
+            self._split_components(endpoints)
+
+    def _split_components(self, endpoints: list):
+        """Split clusters that removed edges have disconnected.
+
+        endpoints are the subclusters that lost edges. Within each cluster,
+        a breadth-first search is grown from every endpoint in turn, one
+        subcluster per search and round. Searches that meet are joined. A
+        group of searches that runs out of subclusters has found a whole
+        connected component, and the search stops once at most one group is
+        still running. Every finished component but one (the running group,
+        or else the largest) becomes a new cluster. The work is bounded by
+        the number of endpoints times the size of the components split off,
+        not by the size of the cluster.
+        """
+        by_cluster = {}
+        for sc in endpoints:
+            if sc.subcluster_id in self.subclusters:
+                by_cluster.setdefault(sc.cluster_id, {})[sc.subcluster_id] = sc
+        inst = self.instrumentation
+        for cluster_id, starts in by_cluster.items():
+            if len(starts) < 2:
+                continue
+            if inst is not None:
+                start = time.perf_counter()
+            starts = [starts[sc_id] for sc_id in sorted(starts)]
+            group = list(range(len(starts)))
+            owner = {sc: i for i, sc in enumerate(starts)}
+            members = [[sc] for sc in starts]
+            queues = [collections.deque([sc]) for sc in starts]
+
+            def find(i):
+                while group[i] != i:
+                    group[i] = group[group[i]]
+                    i = group[i]
+                return i
+
+            running = set(range(len(starts)))
+            while len(running) > 1:
+                for i, queue in enumerate(queues):
+                    if not queue:
+                        continue
+                    for neighbour in sorted(queue.popleft().connected_subclusters,
+                                            key=lambda sc: sc.subcluster_id):
+                        if neighbour not in owner:
+                            owner[neighbour] = i
+                            members[find(i)].append(neighbour)
+                            queue.append(neighbour)
+                            continue
+                        root, other = find(i), find(owner[neighbour])
+                        if root != other:
+                            if len(members[root]) < len(members[other]):
+                                root, other = other, root
+                            group[other] = root
+                            members[root].extend(members[other])
+                            members[other] = None
+                running = {find(i) for i, queue in enumerate(queues) if queue}
+            roots = {find(i) for i in range(len(starts))}
+            if len(roots) == 1:
+                continue
+            kept = running.pop() if running else \
+                max(roots, key=lambda root: (len(members[root]), -root))
+            for root in sorted(roots - {kept}):
+                new_cluster_id = self._new_cluster()
+                for sc in sorted(members[root], key=lambda sc: sc.subcluster_id):
+                    self._move_subcluster(sc, new_cluster_id)
+                if inst is not None:
+                    inst.count('splits')
+                    inst.emit('split', cluster_id, new_cluster_id, members[root])
+            if inst is not None:
+                inst.record('split', time.perf_counter() - start)
+
+    def point_labels(self) -> np.ndarray:
+        """Current cluster ids of all vectors predicted so far, in order.
+
+        Needs track_labels. Merged subclusters point to the subcluster they
+        were merged into, and these chains are followed for all vectors at
+        once by pointer jumping, so the cost is linear in the number of
+        vectors and subclusters. Vectors of evicted subclusters get -1.
 
-    def get_all_vectors(self):
+        Returns:
+            np.ndarray
+                Integer cluster ids of shape (n,)
+        """
+        if not self.track_labels:
+            raise ValueError("point_labels needs a model created with track_labels=True.")
+        parents = find_roots(np.array(self.subcluster_parents, dtype=np.int64))
+        # Keep the compressed paths for the next call
+        self.subcluster_parents = array('q', parents.tobytes())
+        cluster_of = np.full(len(parents), -1, dtype=np.int64)
+        if self.subclusters:
+            cluster_of[list(self.subclusters)] = [sc.cluster_id
+                                                  for sc in self.subclusters.values()]
+        return cluster_of[parents[np.array(self.point_subclusters, dtype=np.int64)]]
+
+    def freeze(self) -> FrozenLinksCluster:
+        """Read-only, thread-safe classifier of the current clusters.
+
+        The frozen model copies the live centroids once and is not affected
+        by later training, so it can be refreshed by freezing again.
+        """
+        matrix = self.centroid_matrix
+        rows = [row for row, sc in enumerate(matrix.subclusters[:matrix.n_rows])
+                if sc is not None]
+        if self.sparse_input:
+            centroids = stack_rows([matrix.rows[row] for row in rows], matrix.dim or 0,
+                                   self.dtype)
+        elif rows:
+            centroids = matrix.vectors[rows]
+        else:
+            centroids = np.empty((0, 0), dtype=self.dtype)
+        return FrozenLinksCluster(
+            centroids, matrix.cluster_ids[rows],
+            np.array([matrix.subclusters[row].subcluster_id for row in rows], dtype=np.int64))
+
+    def get_all_vectors(self) -> np.ndarray:
         """Return all stored vectors from entire history.
 
         Returns:
-            list
-                list of vectors
+            np.ndarray
+                Array of vectors in arrival order, a view of the arena
+                whenever possible
+
+        Raises:
+            RuntimeError
+                if self.store_vectors is False (i.e. there are no stored vectors)
+        """
+        if not self.store_vectors:
+            raise RuntimeError("Vectors were not stored, so can't be collected")
+        return self.vector_arena.view()
+
+    def get_cluster_vectors(self, cluster_id: int) -> np.ndarray:
+        """Return the stored vectors of the cluster with id cluster_id.
+
+        Returns:
+            np.ndarray
+                Array of the vectors of every subcluster of the cluster
 
         Raises:
             RuntimeError
@@ -219,16 +1987,326 @@ class LinksCluster:
         """
         if not self.store_vectors:
             raise RuntimeError("Vectors were not stored, so can't be collected")
-        all_vectors = []
-        for cl in self.clusters:
-            for scl in cl:
-                all_vectors += scl.input_vectors
-        return all_vectors
+        vector_ids = array('q')
+        for scl in self.cluster_members[cluster_id].values():
+            vector_ids.extend(scl.vector_ids)
+        return self.vector_arena.take(np.frombuffer(vector_ids, dtype=np.int64))
+
+    def save(self, path: str):
+        """Write a snapshot of the model to the directory path.
+
+        The snapshot is a set of .npy arrays (centroids, counts, cluster
+        membership, edges and, with store_vectors, the stored vectors) plus
+        state.json for the hyperparameters. With sparse_input, centroids and
+        vectors are written as the data, indices and indptr arrays of CSR
+        matrices. It can be memory-mapped by load.
+        Every file is replaced atomically, so a model can be saved over the
+        snapshot it was memory-mapped from.
+        """
+        os.makedirs(path, exist_ok=True)
+        subclusters = [sc for members in self.cluster_members.values()
+                       for sc in members.values()]
+        arrays = {
+            'cluster_order': np.array(list(self.cluster_members), dtype=np.int64),
+            'subcluster_ids': np.array([sc.subcluster_id for sc in subclusters],
+                                       dtype=np.int64),
+            'cluster_ids': np.array([sc.cluster_id for sc in subclusters], dtype=np.int64),
+            'counts': np.array([sc.n_vectors for sc in subclusters], dtype=np.int64),
+            'last_updates': np.array([sc.last_update for sc in subclusters], dtype=np.int64),
+            'log_weights': np.array([sc.log_weight for sc in subclusters], dtype=np.float64),
+            'edges': np.array([(sc.subcluster_id, connected_sc.subcluster_id)
+                               for sc in subclusters
+                               for connected_sc in sc.connected_subclusters
+                               if sc.subcluster_id < connected_sc.subcluster_id],
+                              dtype=np.int64).reshape(-1, 2),
+        }
+        if subclusters and self.sparse_input:
+            centroids = sparse.vstack([sparse.csr_matrix(sc.centroid.reshape(1, -1))
+                                       if not sparse.issparse(sc.centroid) else sc.centroid
+                                       for sc in subclusters], format='csr')
+            arrays.update(centroids_data=centroids.data, centroids_indices=centroids.indices,
+                          centroids_indptr=centroids.indptr,
+                          centroid_norms=np.sqrt(np.asarray(
+                              centroids.multiply(centroids).sum(axis=1)).ravel()))
+        elif subclusters:
+            arrays['centroids'] = np.stack([sc.centroid for sc in subclusters])
+            arrays['centroid_norms'] = np.linalg.norm(arrays['centroids'], axis=1)
+            if self.compensated:
+                arrays['compensations'] = np.stack([sc.compensation for sc in subclusters])
+        if self.track_labels:
+            arrays['point_subclusters'] = np.array(self.point_subclusters, dtype=np.int64)
+            arrays['subcluster_parents'] = np.array(self.subcluster_parents, dtype=np.int64)
+        if self.store_vectors and subclusters:
+            arrays['vector_offsets'] = np.cumsum(
+                [0] + [len(sc.vector_ids) for sc in subclusters], dtype=np.int64)
+            vector_ids = array('q')
+            for sc in subclusters:
+                vector_ids.extend(sc.vector_ids)
+            arrays['vector_ids'] = np.frombuffer(vector_ids, dtype=np.int64)
+            vectors = self.vector_arena.view()
+            if self.sparse_input:
+                arrays.update(vectors_data=vectors.data, vectors_indices=vectors.indices,
+                              vectors_indptr=vectors.indptr)
+            else:
+                arrays['vectors'] = vectors
+        for name, values in arrays.items():
+            filename = os.path.join(path, name + '.npy')
+            with open(filename + '.tmp', 'wb') as f:
+                np.save(f, values)
+            os.replace(filename + '.tmp', filename)
+        state = {
+            'cluster_similarity_threshold': self.cluster_similarity_threshold,
+            'subcluster_similarity_threshold': self.subcluster_similarity_threshold,
+            'pair_similarity_maximum': self.pair_similarity_maximum,
+            'store_vectors': self.store_vectors,
+            'dtype': self.dtype.str,
+            'next_subcluster_id': self.next_subcluster_id,
+            'next_cluster_id': self.next_cluster_id,
+            'clock': self.clock,
+            'max_subclusters': self.max_subclusters,
+            'max_age': self.max_age,
+            'eviction': self.eviction,
+            'decay_rate': self.decay_rate,
+            'cluster_pruning': self.cluster_pruning,
+            'sparse_input': self.sparse_input,
+            'dim': self.centroid_matrix.dim if self.sparse_input else None,
+            'track_labels': self.track_labels,
+        }
+        filename = os.path.join(path, 'state.json')
+        with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(filename + '.tmp', filename)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True, index=None) -> 'LinksCluster':
+        """Restore a model written by save.
+
+        Args:
+            path: str
+                Snapshot directory
+            mmap: bool
+                Memory-map the arrays instead of reading them. Centroids and
+                stored vectors then stay views of the snapshot until updated.
+                Subclusters, edges and the centroid matrix are rebuilt all
+                the same, in time linear in their number. For classifying
+                only, FrozenLinksCluster.load opens a snapshot in place.
+            index:
+                Optional centroid index for the restored model
+
+        Returns:
+            LinksCluster
+                The restored model
+        """
+        with open(os.path.join(path, 'state.json'), encoding='utf-8') as f:
+            state = json.load(f)
+        mmap_mode = 'r' if mmap else None
+
+        def load_array(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+
+        model = cls(state['cluster_similarity_threshold'],
+                    state['subcluster_similarity_threshold'],
+                    state['pair_similarity_maximum'],
+                    store_vectors=state['store_vectors'],
+                    index=index,
+                    dtype=state['dtype'],
+                    max_subclusters=state.get('max_subclusters'),
+                    max_age=state.get('max_age'),
+                    eviction=state.get('eviction', 'lru'),
+                    decay_rate=state.get('decay_rate', 1e-3),
+                    cluster_pruning=state.get('cluster_pruning', False),
+                    sparse_input=state.get('sparse_input', False),
+                    track_labels=state.get('track_labels', False))
+        model.next_subcluster_id = state['next_subcluster_id']
+        model.next_cluster_id = state['next_cluster_id']
+        model.clock = state.get('clock', 0)
+        if model.track_labels:
+            model.point_subclusters = array('q', load_array('point_subclusters').tobytes())
+            model.subcluster_parents = array('q', load_array('subcluster_parents').tobytes())
+        for cluster_id in load_array('cluster_order').tolist():
+            model.cluster_members[cluster_id] = {}
+        subcluster_ids = load_array('subcluster_ids').tolist()
+        if not subcluster_ids:
+            return model
+        cluster_ids = load_array('cluster_ids').tolist()
+        counts = load_array('counts').tolist()
+        if os.path.exists(os.path.join(path, 'last_updates.npy')):
+            last_updates = load_array('last_updates').tolist()
+            log_weights = load_array('log_weights').tolist()
+        else:
+            last_updates = [0] * len(subcluster_ids)
+            log_weights = [0.0] * len(subcluster_ids)
+        if model.sparse_input:
+            shape = (len(subcluster_ids), state['dim'])
+            centroids = sparse.csr_matrix((load_array('centroids_data'),
+                                           load_array('centroids_indices'),
+                                           load_array('centroids_indptr')), shape=shape)
+        else:
+            centroids = load_array('centroids')
+        if model.compensated:
+            compensations = load_array('compensations')
+        if model.store_vectors and model.sparse_input:
+            indptr = load_array('vectors_indptr')
+            model.vector_arena = SparseVectorArena.from_csr(sparse.csr_matrix(
+                (load_array('vectors_data'), load_array('vectors_indices'), indptr),
+                shape=(len(indptr) - 1, state['dim'])))
+        elif model.store_vectors:
+            model.vector_arena = VectorArena.from_array(load_array('vectors'))
+        if model.store_vectors:
+            vector_ids = load_array('vector_ids')
+            vector_offsets = load_array('vector_offsets').tolist()
+        for i, (sc_id, cluster_id, count) in enumerate(zip(subcluster_ids, cluster_ids, counts)):
+            sc = Subcluster(centroids[i])
+            sc.n_vectors = count
+            sc.last_update = last_updates[i]
+            sc.log_weight = log_weights[i]
+            if model.compensated:
+                sc.compensation = compensations[i]
+            if model.store_vectors:
+                sc.store_vectors = True
+                sc.arena = model.vector_arena
+                sc.vector_ids = array(
+                    'q', vector_ids[vector_offsets[i]:vector_offsets[i + 1]].tobytes())
+            sc.subcluster_id = sc_id
+            sc.cluster_id = cluster_id
+            model.subclusters[sc_id] = sc
+            model.cluster_members[cluster_id][sc_id] = sc
+            model.centroid_matrix.add(sc, cluster_id)
+        for sc_id1, sc_id2 in load_array('edges').tolist():
+            model.add_edge(model.subclusters[sc_id1], model.subclusters[sc_id2])
+        model._rebuild_heaps()
+        return model
+
+    @classmethod
+    def merge_models(cls, *models: 'LinksCluster', **kwargs) -> 'LinksCluster':
+        """Combine models trained on separate shards of the data into one.
+
+        The subclusters of the models are inserted one by one, model by
+        model. Each is linked to the most similar subcluster inserted before
+        it when they pass sim_threshold, and merged into it with
+        Subcluster.merge when they also pass the subcluster threshold, as a
+        vector would be. Edges to subclusters of its own model are kept
+        while they still pass sim_threshold. Clusters linked by an edge
+        become one cluster, and clusters cut by merges are split.
+
+        Stored vectors are concatenated in model order. When every model has
+        track_labels, so are the point labels, and vectors of evicted
+        subclusters keep the label -1.
+
+        Args:
+            *models: LinksCluster
+                Models with the same thresholds, dtype, store_vectors and
+                sparse_input. They are not changed.
+            **kwargs:
+                Further arguments of the merged model, overriding those
+                taken from the first model
+
+        Returns:
+            LinksCluster
+                The merged model
+        """
+        if not models:
+            raise ValueError("merge_models needs at least one model.")
+        first = models[0]
+        for name in ('cluster_similarity_threshold', 'subcluster_similarity_threshold',
+                     'pair_similarity_maximum', 'store_vectors', 'dtype', 'sparse_input'):
+            if any(getattr(model, name) != getattr(first, name) for model in models):
+                raise ValueError(f"Models with different {name} can't be merged.")
+        options = dict(store_vectors=first.store_vectors, dtype=first.dtype,
+                       max_subclusters=first.max_subclusters, max_age=first.max_age,
+                       eviction=first.eviction, decay_rate=first.decay_rate,
+                       cluster_pruning=first.cluster_pruning, sparse_input=first.sparse_input,
+                       track_labels=all(model.track_labels for model in models))
+        options.update(kwargs)
+        merged = cls(first.cluster_similarity_threshold,
+                     first.subcluster_similarity_threshold,
+                     first.pair_similarity_maximum,
+                     **options)
+        vector_offsets = np.cumsum([0] + [len(model.vector_arena) if model.store_vectors else 0
+                                          for model in models])
+        if merged.store_vectors and vector_offsets[-1]:
+            views = [model.vector_arena.view() for model in models if len(model.vector_arena)]
+            merged.vector_arena = SparseVectorArena.from_csr(sparse.vstack(views, format='csr')) \
+                if merged.sparse_input else VectorArena.from_array(np.concatenate(views))
+
+        def resolve(subcluster):
+            while subcluster in merged.merged_into:
+                subcluster = merged.merged_into[subcluster]
+            return subcluster
+
+        def link(sc1, sc2, similarity):
+            sc1, sc2 = resolve(sc1), resolve(sc2)
+            if sc1 is sc2 or sc2 in sc1.connected_subclusters \
+                    or similarity < merged.sim_threshold(sc1.n_vectors, sc2.n_vectors):
+                return False
+            if sc1.cluster_id != sc2.cluster_id:
+                merged._join_clusters(sc1.cluster_id, sc2.cluster_id)
+            merged.add_edge(sc1, sc2)
+            return True
+
+        evicted = None
+        for model, vector_offset in zip(models, vector_offsets.tolist()):
+            copies = {}
+            for source in sorted(model.subclusters.values(), key=attrgetter('subcluster_id')):
+                subcluster = Subcluster(source.centroid.copy())
+                subcluster.n_vectors = source.n_vectors
+                subcluster.last_update = source.last_update
+                subcluster.log_weight = source.log_weight
+                if merged.compensated and source.compensation is not None:
+                    subcluster.compensation = source.compensation.copy()
+                elif merged.compensated:
+                    subcluster.compensation = np.zeros_like(source.centroid)
+                if merged.store_vectors:
+                    subcluster.store_vectors = True
+                    subcluster.arena = merged.vector_arena
+                    subcluster.vector_ids = array('q', (np.frombuffer(
+                        source.vector_ids, dtype=np.int64) + vector_offset).tobytes())
+                best, similarity, cluster_id = None, -np.inf, None
+                if merged.subclusters:
+                    query = subcluster.centroid
+                    if merged.sparse_input and not sparse.issparse(query):
+                        query = sparse.csr_matrix(query.reshape(1, -1))
+                    best = merged.centroid_matrix.subclusters[
+                        merged.centroid_matrix.nearest(query, exact=True)]
+                    similarity = merged._cosine_similarity(subcluster.centroid, best.centroid)
+                    if similarity >= merged.sim_threshold(best.n_vectors, subcluster.n_vectors):
+                        cluster_id = best.cluster_id
+                if cluster_id is None:
+                    cluster_id = merged._new_cluster()
+                merged._register_subcluster(subcluster, cluster_id)
+                copies[source.subcluster_id] = subcluster
+                for connected_sc in source.connected_subclusters:
+                    if connected_sc.subcluster_id in copies:
+                        other = resolve(copies[connected_sc.subcluster_id])
+                        link(subcluster, other,
+                             merged._cosine_similarity(subcluster.centroid, other.centroid))
+                if best is not None and link(best, subcluster, similarity) \
+                        and similarity >= merged.subcluster_similarity_threshold:
+                    merged._merge_subclusters(best, subcluster)
+            if merged.track_labels:
+                roots = find_roots(np.array(model.subcluster_parents, dtype=np.int64))
+                new_ids = np.full(len(roots), -1, dtype=np.int64)
+                new_ids[list(copies)] = [sc.subcluster_id for sc in copies.values()]
+                point_ids = new_ids[roots[np.array(model.point_subclusters, dtype=np.int64)]]
+                if evicted is None and (point_ids == -1).any():
+                    # Never registered, so its vectors are labelled -1
+                    evicted = merged.next_subcluster_id
+                    merged.next_subcluster_id += 1
+                    merged.subcluster_parents.append(evicted)
+                point_ids[point_ids == -1] = -1 if evicted is None else evicted
+                merged.point_subclusters.frombytes(point_ids.tobytes())
+        merged._split_pending()
+        merged.clock = max(model.clock for model in models)
+        if merged.bounded:
+            merged._rebuild_heaps()
+        return merged
 
     def sim_threshold(self, k: int, kp: int) -> float:
         """Compute the similarity threshold.
 
-        This is based on equations (16) and (24) of the paper.
+        This is based on equations (16) and (24) of the paper. k and kp
+        may also be integer arrays, the thresholds are then computed
+        elementwise.
 
         Args:
             k: int
@@ -249,3 +2327,123 @@ class LinksCluster:
             / (1.0 - self.cluster_similarity_threshold ** 2) \
             * (s - self.cluster_similarity_threshold ** 2)  # eq. (24)
         return s
+
+
+def read_vectors(path: str, dim: int = None, key: str = None, chunk_size: int = 65536):
+    """Vectors of a .npy or .npz file, or raw float32 rows from stdin for path '-'.
+
+    A .npy file is returned as its path, to be memory-mapped by iter_stream.
+    From stdin, 2-D arrays of at most chunk_size rows of dim values are
+    yielded as they arrive.
+    """
+    if path == '-':
+        if dim is None:
+            raise ValueError("Reading raw float32 vectors from stdin needs --dim.")
+        return _read_raw(sys.stdin.buffer, dim, chunk_size)
+    if path.endswith('.npz'):
+        with np.load(path) as arrays:
+            return arrays[key or arrays.files[0]]
+    return path
+
+
+def _read_raw(stream, dim: int, chunk_size: int):
+    """Chunks of float32 rows of length dim read from a binary stream."""
+    row_bytes = 4 * dim
+    while True:
+        buffer = bytearray()
+        while len(buffer) < chunk_size * row_bytes:
+            data = stream.read(chunk_size * row_bytes - len(buffer))
+            if not data:
+                break
+            buffer += data
+        if len(buffer) % row_bytes:
+            raise ValueError(f"Input ends within a vector, {len(buffer) % row_bytes} bytes "
+                             f"of {row_bytes} left over.")
+        if buffer:
+            yield np.frombuffer(buffer, dtype=np.float32).reshape(-1, dim)
+        if len(buffer) < chunk_size * row_bytes:
+            return
+
+
+def main(argv=None) -> int:
+    """Cluster vectors from the command line, print labels and a summary."""
+    parser = argparse.ArgumentParser(
+        prog='python -m links_cluster',
+        description="Cluster vectors with LinksCluster and write one label per vector. "
+                    "A summary of the run is printed to stderr.")
+    parser.add_argument('input', help="A .npy or .npz file, or - for raw float32 rows on stdin")
+    parser.add_argument('--cluster-similarity-threshold', type=float, required=True)
+    parser.add_argument('--subcluster-similarity-threshold', type=float, required=True)
+    parser.add_argument('--pair-similarity-maximum', type=float, required=True)
+    parser.add_argument('--dim', type=int, help="Vector dimension of raw input")
+    parser.add_argument('--key', help="Array of a .npz file, the first one by default")
+    parser.add_argument('--output', '-o',
+                        help="Write labels to this file, as an array if it ends with .npy, "
+                             "else one per line. Stdout by default.")
+    parser.add_argument('--chunk-size', type=int, default=65536)
+    parser.add_argument('--dtype', default='float64', choices=['float32', 'float64'])
+    parser.add_argument('--max-subclusters', type=int)
+    parser.add_argument('--profile', nargs='?', const='', metavar='FILE',
+                        help="Print a cProfile report to stderr, and save the raw "
+                             "statistics to FILE if given")
+    parser.add_argument('--profile-limit', type=int, default=25,
+                        help="Number of functions in the profile report")
+    args = parser.parse_args(argv)
+
+    source = read_vectors(args.input, args.dim, args.key, args.chunk_size)
+    instrumentation = Instrumentation()
+    model = LinksCluster(args.cluster_similarity_threshold,
+                         args.subcluster_similarity_threshold,
+                         args.pair_similarity_maximum,
+                         dtype=args.dtype,
+                         instrumentation=instrumentation,
+                         max_subclusters=args.max_subclusters)
+    to_array = args.output is not None and args.output.endswith('.npy')
+    if args.output is None:
+        output = sys.stdout
+    elif not to_array:
+        output = open(args.output, 'w', encoding='utf-8')  # pylint: disable=consider-using-with
+    collected = []
+    profiler = cProfile.Profile() if args.profile is not None else None
+    started = time.perf_counter()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        for labels in model.iter_stream(source, args.chunk_size):
+            if to_array:
+                collected.append(labels)
+            else:
+                output.write('\n'.join(map(str, labels.tolist())) + '\n')
+        if profiler is not None:
+            profiler.disable()
+    finally:
+        if args.output is not None and not to_array:
+            output.close()
+    seconds = time.perf_counter() - started
+    if to_array:
+        np.save(args.output, np.concatenate(collected) if collected
+                else np.empty(0, dtype=np.int64))
+
+    n_vectors = instrumentation.counters['predictions']
+    print(f"vectors: {n_vectors}", file=sys.stderr)
+    print(f"seconds: {seconds:.3f}", file=sys.stderr)
+    print(f"vectors/sec: {n_vectors / seconds if seconds > 0 else 0.0:.1f}", file=sys.stderr)
+    print(f"clusters: {len(model.cluster_members)}", file=sys.stderr)
+    print(f"subclusters: {len(model.subclusters)}", file=sys.stderr)
+    phases = instrumentation.summary()['phases']
+    if phases:
+        print(f"{'phase':<16}{'calls':>10}{'total s':>12}{'mean us':>12}{'p99 us':>12}",
+              file=sys.stderr)
+        for phase, stats in phases.items():
+            print(f"{phase:<16}{stats['calls']:>10}{stats['total']:>12.3f}"
+                  f"{1e6 * stats['mean']:>12.1f}{1e6 * stats['p99']:>12.1f}", file=sys.stderr)
+    if profiler is not None:
+        stats = pstats.Stats(profiler, stream=sys.stderr)
+        stats.sort_stats('cumulative').print_stats(args.profile_limit)
+        if args.profile:
+            stats.dump_stats(args.profile)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
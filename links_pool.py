@@ -0,0 +1,393 @@
+"""Process pools for LinksCluster: many sessions, or one model trained in shards.
+
+Each session is one LinksCluster, living in the worker process its id is
+routed to. Vectors and labels move between processes through per-worker
+shared memory buffers, only small control messages are pickled.
+
+fit_shards trains one model per shard of a large offline data set in
+parallel, and merges them with LinksCluster.merge_models.
+"""
+import copy
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.connection import wait
+
+import numpy as np
+
+from links_cluster import LinksCluster
+
+
+def route(session_id, n_workers: int) -> int:
+    """Index of the worker that owns session_id, stable across runs."""
+    return zlib.crc32(str(session_id).encode()) % n_workers
+
+
+def session_path(snapshot_dir: str, session_id) -> str:
+    """Snapshot directory of session_id inside snapshot_dir."""
+    return os.path.join(snapshot_dir, hashlib.sha1(str(session_id).encode()).hexdigest())
+
+
+class _SessionWorker:
+    """Worker process state: the sessions routed to one worker."""
+    def __init__(self, conn, in_buffer, out_buffer, cluster_args, cluster_kwargs,
+                 snapshot_dir, idle_timeout):
+        self.conn = conn
+        self.in_buffer = np.frombuffer(in_buffer, dtype=np.uint8)
+        self.out_buffer = np.frombuffer(out_buffer, dtype=np.uint8)
+        self.cluster_args = cluster_args
+        self.cluster_kwargs = cluster_kwargs
+        self.snapshot_dir = snapshot_dir
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.last_used = {}
+
+    def session(self, session_id) -> LinksCluster:
+        """Live model of session_id, restored from its snapshot or created.
+
+        Every session gets its own copy of the index, instrumentation and
+        other objects in cluster_kwargs, since models update them in place.
+        """
+        model = self.sessions.get(session_id)
+        if model is None:
+            kwargs = copy.deepcopy(self.cluster_kwargs)
+            path = session_path(self.snapshot_dir, session_id) if self.snapshot_dir else None
+            if path is not None and os.path.exists(os.path.join(path, 'state.json')):
+                # Snapshots hold no index, instrumentation or spill_dir
+                model = LinksCluster.load(path, mmap=False, index=kwargs.get('index'))
+                model.instrumentation = kwargs.get('instrumentation')
+                if model.store_vectors and kwargs.get('spill_dir') is not None:
+                    model.vector_arena.spill_dir = kwargs['spill_dir']
+            else:
+                model = LinksCluster(*self.cluster_args, **kwargs)
+            self.sessions[session_id] = model
+        self.last_used[session_id] = time.monotonic()
+        return model
+
+    def predict(self, session_id, shape, dtype) -> int:
+        """Label the vectors waiting in the input buffer, write labels to the output buffer."""
+        n_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        # The buffer is only overwritten after the labels have been sent back
+        vectors = self.in_buffer[:n_bytes].view(dtype).reshape(shape)
+        labels = self.session(session_id).predict_batch(vectors)
+        self.out_buffer[:labels.nbytes] = labels.view(np.uint8)
+        return len(labels)
+
+    def evict(self, max_idle: float) -> list:
+        """Snapshot and drop sessions idle for more than max_idle seconds."""
+        now = time.monotonic()
+        evicted = [session_id for session_id, last_used in self.last_used.items()
+                   if now - last_used > max_idle]
+        for session_id in evicted:
+            self.sessions.pop(session_id).save(session_path(self.snapshot_dir, session_id))
+            del self.last_used[session_id]
+        return evicted
+
+    def run(self):
+        """Serve commands until told to close.
+
+        Idle sessions are evicted every idle_timeout / 2 seconds, whether or
+        not other sessions keep the worker busy meanwhile.
+        """
+        next_eviction = None
+        if self.idle_timeout is not None:
+            next_eviction = time.monotonic() + self.idle_timeout / 2
+        while True:
+            if next_eviction is not None:
+                now = time.monotonic()
+                if now >= next_eviction:
+                    self.evict(self.idle_timeout)
+                    next_eviction = now + self.idle_timeout / 2
+                if not self.conn.poll(max(0.0, next_eviction - now)):
+                    continue
+            command, *args = self.conn.recv()
+            try:
+                if command == 'predict':
+                    result = self.predict(*args)
+                elif command == 'evict':
+                    result = self.evict(*args)
+                elif command == 'sessions':
+                    result = list(self.sessions)
+                elif command == 'close':
+                    if self.snapshot_dir is not None and args[0]:
+                        self.evict(-1.0)
+                    self.conn.send(('ok', None))
+                    return
+                else:
+                    raise ValueError(f"Unknown command {command}.")
+            except Exception as e:  # pylint: disable=broad-except
+                self.conn.send(('error', e))
+            else:
+                self.conn.send(('ok', result))
+
+
+def _worker_main(*args):
+    """Entry point of a worker process."""
+    _SessionWorker(*args).run()
+
+
+class LinksClusterPool:
+    """Shard named LinksCluster sessions across a pool of worker processes.
+
+    Sessions are routed to workers by a stable hash of their id, so every
+    session is served by one process and sees its vectors in order. Sessions
+    on different workers run in parallel.
+
+    Args:
+        cluster_similarity_threshold, subcluster_similarity_threshold,
+        pair_similarity_maximum:
+            Hyperparameters of every session
+        n_workers: int
+            Number of worker processes, os.cpu_count() by default
+        snapshot_dir: str
+            Directory for session snapshots. Evicted sessions are saved
+            there and restored on their next request.
+        idle_timeout: float
+            Seconds after which idle sessions are evicted automatically
+        buffer_size: int
+            Bytes of shared memory per worker and direction. Larger
+            batches are sent in pieces.
+        mp_context:
+            multiprocessing context used to start the workers
+        **cluster_kwargs:
+            Further LinksCluster arguments of every session
+    """
+    def __init__(self,
+                 cluster_similarity_threshold: float,
+                 subcluster_similarity_threshold: float,
+                 pair_similarity_maximum: float,
+                 n_workers: int = None,
+                 snapshot_dir: str = None,
+                 idle_timeout: float = None,
+                 buffer_size: int = 1 << 24,
+                 mp_context=None,
+                 **cluster_kwargs):
+        if idle_timeout is not None and snapshot_dir is None:
+            raise ValueError("idle_timeout needs a snapshot_dir to evict sessions to.")
+        ctx = mp_context or multiprocessing.get_context()
+        self.n_workers = n_workers or os.cpu_count()
+        self.snapshot_dir = snapshot_dir
+        self.buffer_size = buffer_size
+        self.dtype = np.dtype(cluster_kwargs.get('dtype', np.float64))
+        cluster_args = (cluster_similarity_threshold,
+                        subcluster_similarity_threshold,
+                        pair_similarity_maximum)
+        self.conns = []
+        self.in_buffers = []
+        self.out_buffers = []
+        self.processes = []
+        self.locks = []
+        self.current = {}
+        for _ in range(self.n_workers):
+            conn, child_conn = ctx.Pipe()
+            in_buffer = ctx.RawArray('B', buffer_size)
+            out_buffer = ctx.RawArray('B', buffer_size)
+            process = ctx.Process(target=_worker_main,
+                                  args=(child_conn, in_buffer, out_buffer, cluster_args,
+                                        cluster_kwargs, snapshot_dir, idle_timeout),
+                                  daemon=True)
+            process.start()
+            self.conns.append(conn)
+            self.in_buffers.append(np.frombuffer(in_buffer, dtype=np.uint8))
+            self.out_buffers.append(np.frombuffer(out_buffer, dtype=np.uint8))
+            self.processes.append(process)
+            self.locks.append(threading.Lock())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def predict(self, session_id, vector: np.ndarray) -> int:
+        """Predict a cluster id for vector in session session_id."""
+        return int(self.predict_batch(session_id, np.asarray(vector)[np.newaxis])[0])
+
+    def predict_batch(self, session_id, vectors: np.ndarray) -> np.ndarray:
+        """Predict cluster ids for the rows of vectors, in order, in session session_id."""
+        return self.predict_many({session_id: vectors})[session_id]
+
+    def predict_many(self, requests: dict) -> dict:
+        """Run batches for several sessions, in parallel across workers.
+
+        Args:
+            requests: dict
+                Maps session ids to arrays of shape (n, d)
+
+        Returns:
+            dict
+                Maps the same session ids to integer label arrays
+        """
+        queues = {}
+        for session_id, vectors in requests.items():
+            vectors = np.ascontiguousarray(vectors, dtype=self.dtype)
+            if vectors.ndim != 2:
+                raise ValueError(f"Expected a 2-D array, got shape {vectors.shape}.")
+            if vectors[:1].nbytes > self.buffer_size:
+                raise ValueError(f"Rows of {vectors[:1].nbytes} bytes don't fit the "
+                                 f"{self.buffer_size} byte buffer.")
+            # Each label takes 8 bytes of the output buffer
+            rows = max(1, self.buffer_size // max(8, vectors[:1].nbytes))
+            queue = queues.setdefault(route(session_id, self.n_workers), [])
+            queue += [(session_id, vectors[start:start + rows])
+                      for start in range(0, max(1, len(vectors)), rows)]
+        results = {session_id: [] for session_id in requests}
+        workers = sorted(queues)
+        for worker in workers:
+            self.locks[worker].acquire()
+        pending = {}
+        try:
+            for worker in workers:
+                self._send_batch(worker, queues[worker].pop(0))
+                pending[self.conns[worker]] = worker
+            error = None
+            while pending:
+                for conn in wait(list(pending)):
+                    worker = pending.pop(conn)
+                    status, result = conn.recv()
+                    if status == 'error':
+                        error = error or result
+                        continue
+                    session_id, _ = self.current[worker]
+                    results[session_id].append(
+                        self.out_buffers[worker][:8 * result].view(np.int64).copy())
+                    if queues[worker] and error is None:
+                        self._send_batch(worker, queues[worker].pop(0))
+                        pending[conn] = worker
+            if error is not None:
+                raise error
+        finally:
+            # Read the replies still due, so the next request gets its own
+            for conn in pending:
+                conn.recv()
+            for worker in workers:
+                self.locks[worker].release()
+        return {session_id: np.concatenate(labels) if labels else np.empty(0, dtype=np.int64)
+                for session_id, labels in results.items()}
+
+    def _send_batch(self, worker: int, batch: tuple):
+        """Copy batch into the input buffer of worker and ask for its labels."""
+        session_id, vectors = batch
+        self.in_buffers[worker][:vectors.nbytes] = vectors.view(np.uint8).ravel()
+        self.current[worker] = batch
+        self.conns[worker].send(('predict', session_id, vectors.shape, vectors.dtype.str))
+
+    def _broadcast(self, *command) -> list:
+        """Send command to every worker, return their results."""
+        results = []
+        for worker, conn in enumerate(self.conns):
+            with self.locks[worker]:
+                conn.send(command)
+                status, result = conn.recv()
+            if status == 'error':
+                raise result
+            results.append(result)
+        return results
+
+    def evict_idle(self, max_idle: float = 0.0) -> list:
+        """Snapshot and drop sessions idle for more than max_idle seconds, return their ids."""
+        if self.snapshot_dir is None:
+            raise ValueError("Sessions can only be evicted with a snapshot_dir.")
+        return [session_id for evicted in self._broadcast('evict', max_idle)
+                for session_id in evicted]
+
+    def sessions(self) -> list:
+        """Ids of the sessions currently held in memory by the workers."""
+        return [session_id for held in self._broadcast('sessions') for session_id in held]
+
+    def close(self, save: bool = True):
+        """Stop the workers, snapshotting every session first when save and snapshot_dir."""
+        if not self.processes:
+            return
+        try:
+            self._broadcast('close', save)
+        finally:
+            for process in self.processes:
+                process.join(timeout=10)
+                if process.is_alive():
+                    process.terminate()
+            self.processes = []
+
+
+def _fit_shard(shard, path, cluster_args, cluster_kwargs) -> str:
+    """Train a model on shard in a worker process and save it to path."""
+    if isinstance(shard, str):
+        shard = np.load(shard, mmap_mode='r')
+    model = LinksCluster(*cluster_args, **cluster_kwargs)
+    model.fit_predict(shard)
+    model.save(path)
+    return path
+
+
+def fit_shards(shards: list,
+               cluster_similarity_threshold: float,
+               subcluster_similarity_threshold: float,
+               pair_similarity_maximum: float,
+               n_workers: int = None,
+               mp_context=None,
+               **cluster_kwargs) -> LinksCluster:
+    """Train one LinksCluster per shard in a process pool and merge them.
+
+    The models are passed back as snapshots in a temporary directory, and
+    merged in shard order. With track_labels, point_labels of the merged
+    model covers the vectors of all shards in order.
+
+    Args:
+        shards: list
+            Arrays of shape (n, d), or paths of .npy files that workers
+            memory-map
+        cluster_similarity_threshold, subcluster_similarity_threshold,
+        pair_similarity_maximum:
+            Hyperparameters of every model
+        n_workers: int
+            Number of worker processes, os.cpu_count() by default
+        mp_context:
+            multiprocessing context used to start the workers
+        **cluster_kwargs:
+            Further LinksCluster arguments of every model
+
+    Returns:
+        LinksCluster
+            The merged model
+    """
+    cluster_args = (cluster_similarity_threshold,
+                    subcluster_similarity_threshold,
+                    pair_similarity_maximum)
+    with tempfile.TemporaryDirectory() as snapshot_dir, \
+            ProcessPoolExecutor(n_workers or os.cpu_count(), mp_context=mp_context) as pool:
+        paths = pool.map(_fit_shard, shards,
+                         [os.path.join(snapshot_dir, str(i)) for i in range(len(shards))],
+                         [cluster_args] * len(shards), [cluster_kwargs] * len(shards))
+        models = [LinksCluster.load(path, mmap=False) for path in paths]
+        return LinksCluster.merge_models(*models)
+
+
+def rand_index(labels_a: np.ndarray, labels_b: np.ndarray) -> float:
+    """Fraction of pairs of vectors on which two labelings agree.
+
+    A pair agrees when both labelings put it in the same cluster, or both
+    in different ones. Computed from cluster sizes, in O(n log n).
+    """
+    labels_a = np.asarray(labels_a)
+    labels_b = np.asarray(labels_b)
+    if labels_a.shape != labels_b.shape:
+        raise ValueError(f"Labelings of different shapes {labels_a.shape} and {labels_b.shape}.")
+    n = len(labels_a)
+    if n < 2:
+        return 1.0
+    _, a = np.unique(labels_a, return_inverse=True)
+    _, b = np.unique(labels_b, return_inverse=True)
+
+    def n_pairs(counts):
+        return float(np.sum(counts * (counts - 1))) / 2
+
+    same_a = n_pairs(np.bincount(a))
+    same_b = n_pairs(np.bincount(b))
+    same_both = n_pairs(np.unique(a * (b.max() + 1) + b, return_counts=True)[1])
+    total = n * (n - 1) / 2
+    return (total - same_a - same_b + 2 * same_both) / total
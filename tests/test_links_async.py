@@ -0,0 +1,79 @@
+"""Tests for AsyncLinksCluster."""
+# pylint: disable=W0201
+
+import asyncio
+
+import numpy as np
+import pytest
+
+from links_async import AsyncLinksCluster
+from links_cluster import LinksCluster
+
+
+class TestAsyncLinksCluster:
+    """Tests for AsyncLinksCluster class."""
+    def setup_method(self):
+        """Setup for tests."""
+        self.thresholds = (0.3, 0.6, 0.8)
+        rng = np.random.default_rng(0)
+        centers = rng.normal(size=(4, 32))
+        self.vectors = centers[rng.integers(4, size=300)] + rng.normal(size=(300, 32))
+
+    def test_concurrent_requests_keep_arrival_order(self):
+        """Test that coalesced requests get the labels of a sequential pass."""
+        async def run():
+            async with AsyncLinksCluster(LinksCluster(*self.thresholds),
+                                         max_batch_size=32, max_wait=0.01) as front:
+                labels = await asyncio.gather(
+                    *(front.predict(vector) for vector in self.vectors))
+                return labels, front.metrics()
+
+        labels, metrics = asyncio.run(run())
+        expected = LinksCluster(*self.thresholds).fit_predict(self.vectors)
+        np.testing.assert_array_equal(labels, expected)
+        assert metrics['vectors'] == len(self.vectors)
+        assert metrics['max_batch_size'] == 32
+        assert metrics['batches'] < len(self.vectors)
+        assert metrics['queue_depth'] == 0
+
+    def test_budget_releases_partial_batch(self):
+        """Test that a lone request is answered once the latency budget runs out."""
+        async def run():
+            front = AsyncLinksCluster(LinksCluster(*self.thresholds),
+                                      max_batch_size=1000, max_wait=0.005)
+            label = await asyncio.wait_for(front.predict(self.vectors[0]), timeout=5.0)
+            metrics = front.metrics()
+            await front.close()
+            return label, metrics
+
+        label, metrics = asyncio.run(run())
+        assert label == 0
+        assert metrics['batches'] == 1
+        assert metrics['max_wait'] >= 0.004
+
+    def test_errors_reach_callers(self):
+        """Test that a malformed vector fails its own caller only, not its batch."""
+        async def run():
+            async with AsyncLinksCluster(LinksCluster(*self.thresholds),
+                                         max_wait=0.05) as front:
+                good = [asyncio.ensure_future(front.predict(vector))
+                        for vector in self.vectors[:5]]
+                await asyncio.sleep(0)
+                with pytest.raises(ValueError):
+                    await front.predict(np.ones(7))
+                with pytest.raises(ValueError):
+                    await front.predict(self.vectors[:2])
+                return await asyncio.gather(*good)
+
+        expected = LinksCluster(*self.thresholds).fit_predict(self.vectors[:5])
+        assert asyncio.run(run()) == expected.tolist()
+
+    def test_closed_front_end_refuses_requests(self):
+        """Test that requests after close are refused."""
+        async def run():
+            front = AsyncLinksCluster(LinksCluster(*self.thresholds))
+            await front.close()
+            with pytest.raises(RuntimeError):
+                await front.predict(self.vectors[0])
+
+        asyncio.run(run())
@@ -0,0 +1,63 @@
+"""Tests for the benchmark suite."""
+import json
+
+import numpy as np
+
+from links_benchmark import compare, main, run_suite, vmf_mixture
+
+
+class TestBenchmark:
+    """Tests for the vMF generator, the suite and the baseline comparison."""
+    def setup_method(self):
+        """Setup for tests."""
+        self.suite = {'n_vectors': 200, 'dim': 16, 'n_clusters': 3, 'repeats': 1,
+                      'thresholds': [(0.5, 0.7, 0.9)], 'store_vectors': [False, True]}
+
+    def test_vmf_concentration(self):
+        """Test that vMF samples are unit vectors, tighter around their mean for larger kappa."""
+        spreads = []
+        for kappa in (50.0, 500.0):
+            vectors, labels = vmf_mixture(2000, 16, 3, kappa, seed=0)
+            np.testing.assert_allclose(np.linalg.norm(vectors, axis=1), 1.0)
+            assert set(labels) == {0, 1, 2}
+            means = np.array([vectors[labels == i].mean(axis=0) for i in range(3)])
+            means /= np.linalg.norm(means, axis=1, keepdims=True)
+            spreads.append(1.0 - np.mean(np.sum(vectors * means[labels], axis=1)))
+        assert spreads[1] < spreads[0] / 5
+
+    def test_vmf_drift(self):
+        """Test that drifting means turn by the given angle over the stream."""
+        vectors, labels = vmf_mixture(4000, 16, 1, 1000.0, drift=np.pi / 2, seed=0)
+        assert set(labels) == {0}
+        assert abs(np.mean(vectors[:200], axis=0) @ np.mean(vectors[-200:], axis=0)) < 0.1
+
+    def test_suite_and_compare(self):
+        """Test that results are JSON and flag regressions beyond the tolerance."""
+        results = json.loads(json.dumps(run_suite(self.suite)))
+        assert len(results['results']) == 2
+        for result in results['results'].values():
+            assert result['throughput'] > 0
+            assert result['p50_latency'] <= result['p99_latency'] <= result['max_latency']
+            assert result['peak_memory'] > 0
+            assert result['n_clusters'] <= result['n_subclusters']
+        assert compare(results, results) == []
+        slower = json.loads(json.dumps(results))
+        name = next(iter(slower['results']))
+        slower['results'][name]['throughput'] /= 2
+        slower['results'][name]['n_clusters'] += 1
+        regressions = compare(slower, results)
+        assert len(regressions) == 2
+        assert all(regression.startswith(name) for regression in regressions)
+        assert [regression for regression in compare(results, slower, tolerance=0.0)
+                if 'throughput' in regression] == []  # Faster is no regression
+
+    def test_main_baseline(self, tmp_path):
+        """Test the command line round trip through a baseline file."""
+        baseline = tmp_path / 'baseline.json'
+        assert main(['--output', str(baseline), '--n-vectors', '100', '--repeats', '1']) == 0
+        saved = json.loads(baseline.read_text())
+        assert saved['suite']['n_vectors'] == 100
+        for result in saved['results'].values():
+            result['n_subclusters'] += 1
+        baseline.write_text(json.dumps(saved))
+        assert main(['--baseline', str(baseline), '--output', str(tmp_path / 'new.json')]) == 1
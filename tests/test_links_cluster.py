@@ -1,9 +1,18 @@
 """Tests for LinksCluster and LinksSubcluster classes."""
-# pylint: disable=W0201, E1101
+# pylint: disable=W0201, W0212, E1101
+
+import io
+import os
+import pstats
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+import pytest
+from scipy import sparse
+from scipy.spatial.distance import cosine
 
-from links_cluster import LinksCluster, Subcluster
+from links_cluster import (FrozenLinksCluster, HyperplaneLSHIndex, Instrumentation,
+                           LinksCluster, Subcluster, VectorArena, main)
 
 
 class TestLinksCluster:
@@ -23,6 +32,31 @@ class TestLinksCluster:
         """Generate random vector of the correct shape."""
         return np.random.random((self.vector_dim))
 
+    def clustered_vecs(self, how_many, n_centers=5, spread=2.2, seed=0):
+        """Generate vectors scattered around a few random directions."""
+        rng = np.random.default_rng(seed)
+        centers = rng.normal(size=(n_centers, self.vector_dim))
+        labels = rng.integers(n_centers, size=how_many)
+        return centers[labels] + spread * rng.normal(size=(how_many, self.vector_dim))
+
+    def sparse_vecs(self, how_many, n_centers=5, seed=0):
+        """Generate sparse rows, each drawing most features from one of a few topics."""
+        rng = np.random.default_rng(seed)
+        topics = [rng.choice(self.vector_dim, 20, replace=False) for _ in range(n_centers)]
+        vectors = np.zeros((how_many, self.vector_dim))
+        for vector in vectors:
+            features = np.concatenate([rng.choice(topics[rng.integers(n_centers)], 8),
+                                       rng.choice(self.vector_dim, 2)])
+            np.add.at(vector, features, rng.random(len(features)) + 0.5)
+        return sparse.csr_matrix(vectors)
+
+    def new_cluster(self, **kwargs):
+        """Create a LinksCluster with the test hyperparameters."""
+        return LinksCluster(self.cluster_similarity_threshold,
+                            self.subcluster_similarity_threshold,
+                            self.pair_similarity_maximum,
+                            **kwargs)
+
     def rotate_vec(self, vector, angle):
         """Rotate a vector in the x-y plane by angle (radians).
 
@@ -169,12 +203,708 @@ class TestLinksCluster:
             self.cluster.predict(vector)
         assert how_many == len(self.cluster.get_all_vectors())
 
+    def test_centroid_matrix_matches_subclusters(self):
+        """Test that the centroid matrix mirrors every subcluster after many predictions."""
+        for _ in range(200):
+            vector = self.random_vec()
+            vector[0] += 10.0 * np.random.uniform(-1, 1)
+            vector[1] += 10.0 * np.random.uniform(-1, 1)
+            self.cluster.predict(vector)
+        matrix = self.cluster.centroid_matrix
+        n_subclusters = sum(len(cl) for cl in self.cluster.clusters)
+        assert len(matrix) == n_subclusters
+        for cl_idx, cl in enumerate(self.cluster.clusters):
+            for sc in cl:
+                assert matrix.subclusters[sc.matrix_row] is sc
+                assert matrix.cluster_ids[sc.matrix_row] == cl_idx
+                np.testing.assert_array_almost_equal(
+                    matrix.vectors[sc.matrix_row],
+                    sc.centroid / np.linalg.norm(sc.centroid))
+
+    def test_centroid_matrix_nearest_matches_scan(self):
+        """Test that the matrix argmax picks the same subcluster as a cosine scan."""
+        for _ in range(100):
+            vector = self.random_vec()
+            vector[0] += 10.0 * np.random.uniform(-1, 1)
+            self.cluster.predict(vector)
+        for _ in range(20):
+            query = self.random_vec()
+            query[0] += 10.0 * np.random.uniform(-1, 1)
+            expected = max(
+                (sc for cl in self.cluster.clusters for sc in cl),
+                key=lambda sc, q=query: 1.0 - cosine(q, sc.centroid))
+            row = self.cluster.centroid_matrix.nearest(query)
+            assert self.cluster.centroid_matrix.subclusters[row] is expected
+
+    def test_predict_batch_matches_predict(self):
+        """Test that predict_batch gives the same labels as predicting one by one."""
+        vectors = self.clustered_vecs(300)
+        expected = [self.cluster.predict(vector) for vector in vectors]
+        batch_cluster = self.new_cluster(store_vectors=True)
+        labels = batch_cluster.predict_batch(vectors, chunk_size=64, max_changed_rows=8)
+        assert labels.dtype.kind == 'i'
+        np.testing.assert_array_equal(labels, expected)
+        assert [len(cl) for cl in batch_cluster.clusters] == \
+            [len(cl) for cl in self.cluster.clusters]
+
+    def test_fit_predict_continues_online(self):
+        """Test that fit_predict on two halves equals one pass of predict."""
+        vectors = self.clustered_vecs(300)
+        expected = [self.cluster.predict(vector) for vector in vectors]
+        batch_cluster = self.new_cluster()
+        labels = np.concatenate([batch_cluster.fit_predict(vectors[:130]),
+                                 batch_cluster.fit_predict(vectors[130:])])
+        np.testing.assert_array_equal(labels, expected)
+
+    def test_predict_batch_rejects_1d(self):
+        """Test that predict_batch needs a 2-D array."""
+        with pytest.raises(ValueError):
+            self.cluster.predict_batch(self.random_vec())
+
+    def test_lsh_index_tracks_rows(self):
+        """Test that the LSH index holds exactly the live rows under their current keys."""
+        index = HyperplaneLSHIndex(n_tables=4, n_bits=6, seed=0)
+        cluster = LinksCluster(0.5, 0.4, 0.9, index=index)
+        for vector in self.clustered_vecs(300, spread=2.6):
+            cluster.predict(vector)
+        matrix = cluster.centroid_matrix
+        live_rows = {sc.matrix_row for cl in cluster.clusters for sc in cl}
+        assert set(index.row_keys) == live_rows
+        for row in live_rows:
+            keys = index.row_keys[row]
+            assert keys == index._keys(matrix.vectors[row])
+            for table, key in zip(index.tables, keys):
+                assert row in table[key]
+
+    def test_lsh_index_agreement(self):
+        """Test that a high-recall LSH index agrees with the exact scan."""
+        vectors = self.clustered_vecs(400, spread=2.6)
+        index = HyperplaneLSHIndex(n_tables=32, n_bits=3, seed=0)
+        cluster = LinksCluster(0.5, 0.4, 0.9, index=index)
+        cluster.fit_predict(vectors[:300])
+        assert cluster.index_agreement(vectors[300:]) >= 0.95
+
+    def test_lsh_index_one_bucket_is_exact(self):
+        """Test that an index whose buckets hold every row labels like the exact scan."""
+        vectors = self.clustered_vecs(300)
+        expected = self.cluster.fit_predict(vectors)
+        cluster = self.new_cluster(index=HyperplaneLSHIndex(n_tables=1, n_bits=0))
+        np.testing.assert_array_equal(cluster.fit_predict(vectors), expected)
+        assert cluster.index_agreement(vectors) == 1.0
+
+    def test_registry_consistent_after_merges(self):
+        """Test that ids, cluster membership and edges stay consistent through merge cascades."""
+        cluster = LinksCluster(0.3, 0.6, 0.8)
+        labels = cluster.fit_predict(self.clustered_vecs(300, spread=1.0))
+        assert cluster.next_subcluster_id > len(cluster.subclusters)  # Some merges happened
+        assert set(labels) <= set(cluster.cluster_members)
+        self.assert_consistent(cluster)
+
+    def assert_consistent(self, cluster):
+        """Check that ids, membership, edges and matrix rows agree, and clusters are connected."""
+        for cluster_id, members in cluster.cluster_members.items():
+            assert members
+            reached = {next(iter(members.values()))}
+            frontier = list(reached)
+            while frontier:
+                for connected_sc in frontier.pop().connected_subclusters:
+                    if connected_sc not in reached:
+                        reached.add(connected_sc)
+                        frontier.append(connected_sc)
+            assert len(reached) == len(members)
+            for sc_id, sc in members.items():
+                assert cluster.subclusters[sc_id] is sc
+                assert sc.subcluster_id == sc_id
+                assert sc.cluster_id == cluster_id
+                assert cluster.centroid_matrix.cluster_ids[sc.matrix_row] == cluster_id
+                for connected_sc in sc.connected_subclusters:
+                    assert sc in connected_sc.connected_subclusters
+                    assert connected_sc.cluster_id == cluster_id
+        assert sum(len(members) for members in cluster.cluster_members.values()) == \
+            len(cluster.subclusters) == len(cluster.centroid_matrix)
+
+    def test_split_disconnected_cluster(self):
+        """Test that a cluster cut in two keeps its larger part and moves the smaller one."""
+        inst = Instrumentation()
+        splits = []
+        inst.on('split', lambda *args: splits.append(args))
+        cluster = self.new_cluster(instrumentation=inst)
+        cluster_id = cluster._new_cluster()
+        chain = [cluster._new_subcluster(self.basis_vec(i), cluster_id) for i in range(5)]
+        for sc1, sc2 in zip(chain, chain[1:]):
+            cluster.add_edge(sc1, sc2)
+        cluster._remove_edge(chain[2], chain[3])
+        cluster.split_endpoints += [chain[2], chain[3]]
+        cluster._split_pending()
+        assert list(cluster.cluster_members[cluster_id]) == [0, 1, 2]
+        assert chain[3].cluster_id == chain[4].cluster_id == 1
+        assert splits == [(cluster_id, 1, [chain[3], chain[4]])]
+        assert inst.summary()['counters']['splits'] == 1
+        self.assert_consistent(cluster)
+
+    def test_point_labels(self, tmp_path):
+        """Test that point labels follow merges, splits and moves of earlier vectors."""
+        vectors = self.clustered_vecs(300, spread=1.0)
+        cluster = LinksCluster(0.3, 0.6, 0.8, store_vectors=True, track_labels=True)
+        labels = cluster.fit_predict(vectors[:200])
+        expected = np.empty(200, dtype=np.int64)
+        for sc in cluster.subclusters.values():
+            expected[np.array(sc.vector_ids)] = sc.cluster_id
+        np.testing.assert_array_equal(cluster.point_labels(), expected)
+        assert (labels != expected).any()  # Some vectors changed cluster later
+        cluster.save(tmp_path)
+        restored = LinksCluster.load(tmp_path)
+        restored.fit_predict(vectors[200:])
+        cluster.fit_predict(vectors[200:])
+        np.testing.assert_array_equal(restored.point_labels(), cluster.point_labels())
+        with pytest.raises(ValueError):
+            self.cluster.point_labels()
+
+    def test_point_labels_evicted(self):
+        """Test that vectors of evicted subclusters are labelled -1."""
+        vectors = self.clustered_vecs(300, spread=1.0)
+        cluster = LinksCluster(0.3, 0.6, 0.8, max_subclusters=8, store_vectors=True,
+                               track_labels=True)
+        cluster.fit_predict(vectors)
+        point_labels = cluster.point_labels()
+        alive = np.concatenate([sc.vector_ids for sc in cluster.subclusters.values()])
+        assert np.count_nonzero(point_labels == -1) == len(vectors) - len(alive)
+        for sc in cluster.subclusters.values():
+            assert (point_labels[np.array(sc.vector_ids)] == sc.cluster_id).all()
+
+    def test_merge_models(self):
+        """Test that merged shard models form one consistent model over all vectors."""
+        vectors = self.clustered_vecs(300, spread=1.0)
+        shards = [LinksCluster(0.3, 0.6, 0.8, store_vectors=True, track_labels=True)
+                  for _ in range(3)]
+        for shard, shard_vectors in zip(shards, np.split(vectors, 3)):
+            shard.fit_predict(shard_vectors)
+        n_subclusters = [len(shard.subclusters) for shard in shards]
+        merged = LinksCluster.merge_models(*shards)
+        self.assert_consistent(merged)
+        assert len(merged.subclusters) < sum(len(shard.subclusters) for shard in shards)
+        assert len(merged.cluster_members) <= 5
+        np.testing.assert_array_equal(merged.get_all_vectors(), vectors)
+        assert sum(sc.n_vectors for sc in merged.subclusters.values()) == len(vectors)
+        expected = np.empty(len(vectors), dtype=np.int64)
+        for sc in merged.subclusters.values():
+            expected[np.array(sc.vector_ids)] = sc.cluster_id
+        np.testing.assert_array_equal(merged.point_labels(), expected)
+        assert [len(shard.subclusters) for shard in shards] == n_subclusters
+        with pytest.raises(ValueError):
+            LinksCluster.merge_models(shards[0], LinksCluster(0.3, 0.6, 0.9))
+
+    def test_cluster_ids_are_stable(self):
+        """Test that a subcluster keeps its ids while other subclusters change."""
+        vector = self.random_vec()
+        vector[0] += 1000.0
+        self.cluster.predict(vector)
+        first_subcluster = self.cluster.subclusters[0]
+        self.cluster.predict(
+            self.rotate_vec(vector, 2 * np.arccos(self.cluster_similarity_threshold)))
+        self.cluster.predict(vector)
+        assert self.cluster.subclusters[0] is first_subcluster
+        assert first_subcluster.cluster_id == 0
+        assert self.cluster.subclusters[1].cluster_id == 1
+
+    @pytest.mark.parametrize('mmap', [True, False])
+    def test_save_load_roundtrip(self, tmp_path, mmap):
+        """Test that a restored model has the same state and keeps predicting the same."""
+        vectors = self.clustered_vecs(300, spread=1.0)
+        cluster = LinksCluster(0.3, 0.6, 0.8, store_vectors=True)
+        cluster.fit_predict(vectors[:200])
+        cluster.save(tmp_path / 'snapshot')
+        restored = LinksCluster.load(tmp_path / 'snapshot', mmap=mmap)
+        assert restored.subcluster_similarity_threshold == 0.6
+        assert list(restored.cluster_members) == list(cluster.cluster_members)
+        for sc_id, sc in cluster.subclusters.items():
+            restored_sc = restored.subclusters[sc_id]
+            assert restored_sc.n_vectors == sc.n_vectors
+            assert restored_sc.cluster_id == sc.cluster_id
+            np.testing.assert_array_equal(restored_sc.centroid, sc.centroid)
+            assert {c.subcluster_id for c in restored_sc.connected_subclusters} == \
+                {c.subcluster_id for c in sc.connected_subclusters}
+        np.testing.assert_array_equal(np.array(restored.get_all_vectors()),
+                                      np.array(cluster.get_all_vectors()))
+        np.testing.assert_array_equal(restored.fit_predict(vectors[200:]),
+                                      cluster.fit_predict(vectors[200:]))
+
+    def test_save_load_float32(self, tmp_path):
+        """Test that dtype and centroid compensation survive a snapshot."""
+        vectors = self.clustered_vecs(200)
+        cluster = self.new_cluster(dtype=np.float32)
+        cluster.fit_predict(vectors[:100])
+        cluster.save(tmp_path)
+        restored = LinksCluster.load(tmp_path)
+        assert restored.dtype == np.float32
+        for sc_id, sc in cluster.subclusters.items():
+            np.testing.assert_array_equal(restored.subclusters[sc_id].compensation,
+                                          sc.compensation)
+        np.testing.assert_array_equal(restored.fit_predict(vectors[100:]),
+                                      cluster.fit_predict(vectors[100:]))
+
+    def test_save_load_empty(self, tmp_path):
+        """Test that an untrained model can be restored."""
+        self.cluster.save(tmp_path)
+        restored = LinksCluster.load(tmp_path)
+        assert restored.clusters == []
+        assert restored.predict(self.random_vec()) == 0
+
+    def test_get_cluster_vectors(self):
+        """Test that the vectors of every cluster together are all stored vectors."""
+        vectors = self.clustered_vecs(300, spread=1.0)
+        cluster = LinksCluster(0.3, 0.6, 0.8, store_vectors=True)
+        labels = cluster.fit_predict(vectors)
+        all_vectors = cluster.get_all_vectors()
+        assert isinstance(all_vectors, np.ndarray)
+        np.testing.assert_array_equal(all_vectors, vectors)
+        per_cluster = [cluster.get_cluster_vectors(cluster_id)
+                       for cluster_id in cluster.cluster_members]
+        assert sum(len(cluster_vectors) for cluster_vectors in per_cluster) == len(vectors)
+        last_cluster_vectors = cluster.get_cluster_vectors(labels[-1])
+        assert (last_cluster_vectors == vectors[-1]).all(axis=1).any()
+
+    def test_spill_vectors_to_disk(self, tmp_path):
+        """Test that spilled vectors live in memory-mapped chunk files."""
+        cluster = self.new_cluster(store_vectors=True, spill_dir=str(tmp_path))
+        vectors = self.clustered_vecs(100)
+        cluster.fit_predict(vectors)
+        assert any(path.suffix == '.npy' for path in tmp_path.rglob('*'))
+        assert all(isinstance(chunk, np.memmap) for chunk in cluster.vector_arena.chunks)
+        np.testing.assert_array_equal(cluster.get_all_vectors(), vectors)
+
+    def test_models_share_spill_dir(self, tmp_path):
+        """Test that models spilling to one directory keep their vectors apart."""
+        first = self.new_cluster(store_vectors=True, spill_dir=str(tmp_path))
+        second = self.new_cluster(store_vectors=True, spill_dir=str(tmp_path))
+        first_vectors, second_vectors = self.clustered_vecs(100), self.clustered_vecs(100, seed=1)
+        first.fit_predict(first_vectors)
+        second.fit_predict(second_vectors)
+        np.testing.assert_array_equal(first.get_all_vectors(), first_vectors)
+        np.testing.assert_array_equal(second.get_all_vectors(), second_vectors)
+
+    def test_float32_end_to_end(self):
+        """Test that a float32 model keeps float32 everywhere."""
+        cluster = self.new_cluster(store_vectors=True, dtype=np.float32)
+        cluster.fit_predict(self.clustered_vecs(100))
+        assert cluster.centroid_matrix.vectors.dtype == np.float32
+        assert cluster.get_all_vectors().dtype == np.float32
+        for sc in cluster.subclusters.values():
+            assert sc.centroid.dtype == np.float32
+            assert sc.compensation.dtype == np.float32
+
+    def test_float32_label_agreement(self):
+        """Test that float32 and float64 models agree on nearly every label."""
+        vectors = self.clustered_vecs(1000, spread=1.0)
+        labels64 = LinksCluster(0.3, 0.6, 0.8).fit_predict(vectors)
+        labels32 = LinksCluster(0.3, 0.6, 0.8, dtype=np.float32).fit_predict(vectors)
+        agreement = np.mean(labels64 == labels32)
+        assert agreement >= 0.99
+
+    def test_instrumentation_counts(self):
+        """Test that counters and events follow the registry through merge cascades."""
+        inst = Instrumentation()
+        merged = []
+        inst.on('merge', lambda survivor, sc: merged.append(sc.subcluster_id))
+        cluster = LinksCluster(0.3, 0.6, 0.8, instrumentation=inst)
+        vectors = self.clustered_vecs(300, spread=1.0)
+        labels = cluster.fit_predict(vectors[:150])
+        for vector in vectors[150:]:
+            cluster.predict(vector)
+        counters = inst.summary()['counters']
+        assert counters['predictions'] == len(vectors)
+        assert counters['merges'] == len(merged) > 0
+        assert all(sc_id not in cluster.subclusters for sc_id in merged)
+        assert counters['new_subclusters'] - counters['merges'] == len(cluster.subclusters)
+        assert counters['new_clusters'] == cluster.next_cluster_id > max(labels)
+        assert counters['similarity_evaluations'] >= len(vectors)
+        n_edges = sum(len(sc.connected_subclusters) for sc in cluster.subclusters.values())
+        assert counters['edges_added'] >= counters['edges_removed'] + n_edges // 2
+        np.testing.assert_array_equal(
+            labels, LinksCluster(0.3, 0.6, 0.8).fit_predict(vectors[:150]))
+
+    def test_instrumentation_phases(self):
+        """Test that phase timings are recorded and summarized."""
+        inst = Instrumentation()
+        cluster = self.new_cluster(instrumentation=inst)
+        vectors = self.clustered_vecs(100)
+        cluster.fit_predict(vectors[:50])
+        for vector in vectors[50:]:
+            cluster.predict(vector)
+        phases = inst.summary()['phases']
+        assert phases['search']['calls'] == 50
+        assert phases['block_search']['calls'] >= 1
+        search = phases['search']
+        assert 0.0 < search['p50'] <= search['p99'] <= search['max']
+        assert search['mean'] == pytest.approx(search['total'] / 50)
+        inst.reset()
+        assert inst.summary() == {'counters': dict.fromkeys(Instrumentation.COUNTERS, 0),
+                                  'phases': {}}
+        with pytest.raises(ValueError):
+            inst.on('no_such_event', print)
+
+    def basis_vec(self, i):
+        """Unit vector along axis i, orthogonal to every other axis."""
+        vector = np.zeros(self.vector_dim)
+        vector[i] = 1.0
+        return vector
+
+    @pytest.mark.parametrize('eviction, evicted', [('lru', 0), ('smallest', 1), ('decay', 0)])
+    def test_eviction_policies(self, eviction, evicted):
+        """Test that each policy evicts the expected subcluster."""
+        cluster = self.new_cluster(max_subclusters=2, eviction=eviction, decay_rate=1.0)
+        for i in [0, 0, 0, 1]:
+            cluster.predict(self.basis_vec(i))
+        cluster.predict(self.basis_vec(2))
+        assert len(cluster.subclusters) == 2
+        assert evicted not in cluster.subclusters
+        assert evicted not in cluster.cluster_members
+        self.assert_consistent(cluster)
+
+    def test_max_age(self):
+        """Test that subclusters not updated for max_age predictions are evicted."""
+        cluster = self.new_cluster(max_age=3)
+        cluster.predict(self.basis_vec(0))
+        for _ in range(3):
+            cluster.predict(self.basis_vec(1))
+        assert 0 in cluster.subclusters
+        cluster.predict(self.basis_vec(1))
+        assert list(cluster.subclusters) == [1]
+        assert cluster.predict(self.basis_vec(0)) == 2
+
+    @pytest.mark.parametrize('eviction', ['lru', 'smallest', 'decay'])
+    def test_eviction_keeps_graph_consistent(self, eviction):
+        """Test that a capped model stays consistent and labels like predict in batches."""
+        vectors = self.clustered_vecs(400, spread=1.0)
+        cluster = LinksCluster(0.3, 0.6, 0.8, max_subclusters=8, eviction=eviction)
+        labels = cluster.fit_predict(vectors)
+        assert len(cluster.subclusters) <= 8
+        assert cluster.next_subcluster_id > 8
+        self.assert_consistent(cluster)
+        assert len(cluster.eviction_heap) <= 4 * len(cluster.subclusters) + 64
+        online = LinksCluster(0.3, 0.6, 0.8, max_subclusters=8, eviction=eviction)
+        np.testing.assert_array_equal([online.predict(vector) for vector in vectors], labels)
+
+    def test_save_load_bounded(self, tmp_path):
+        """Test that eviction settings and state survive a snapshot."""
+        vectors = self.clustered_vecs(300, spread=1.0)
+        cluster = LinksCluster(0.3, 0.6, 0.8, max_subclusters=6, max_age=50,
+                               eviction='decay', decay_rate=0.01)
+        cluster.fit_predict(vectors[:150])
+        cluster.save(tmp_path)
+        restored = LinksCluster.load(tmp_path)
+        assert restored.clock == cluster.clock == 150
+        assert restored.eviction == 'decay'
+        np.testing.assert_array_equal(restored.fit_predict(vectors[150:]),
+                                      cluster.fit_predict(vectors[150:]))
+
+    def test_unknown_eviction_policy(self):
+        """Test that unknown policies are refused."""
+        with pytest.raises(ValueError):
+            self.new_cluster(max_subclusters=10, eviction='random')
+
+    @pytest.mark.parametrize('kwargs', [{'max_subclusters': 0}, {'max_age': -1}])
+    def test_invalid_bounds(self, kwargs):
+        """Test that bounds that would evict the subcluster just assigned are refused."""
+        with pytest.raises(ValueError):
+            self.new_cluster(**kwargs)
+        assert self.new_cluster(max_age=0).predict(self.basis_vec(0)) == 0
+
+    @pytest.mark.parametrize('kwargs', [{}, {'dtype': np.float32}, {'max_subclusters': 20}])
+    def test_cluster_pruning_is_exact(self, kwargs):
+        """Test that pruned searches label exactly like full scans."""
+        vectors = self.clustered_vecs(400, n_centers=20, spread=1.0)
+        reference = LinksCluster(0.3, 0.6, 0.8, **kwargs)
+        expected = [reference.predict(vector) for vector in vectors]
+        cluster = LinksCluster(0.3, 0.6, 0.8, cluster_pruning=True, **kwargs)
+        assert [cluster.predict(vector) for vector in vectors] == expected
+        matrix = cluster.centroid_matrix
+        bounds = matrix.bounds
+        assert sorted(bounds.slots) == sorted(cluster.cluster_members)
+        for cluster_id, slot in bounds.slots.items():
+            rows = bounds.rows(slot)
+            assert sorted(rows) == sorted(sc.matrix_row for sc
+                                          in cluster.cluster_members[cluster_id].values())
+            cos_angles = np.clip(matrix.vectors[rows] @ bounds.centers[slot], -1.0, 1.0)
+            assert (np.arccos(cos_angles) <= bounds.radii[slot] + 1e-6).all()
+
+    def test_cluster_pruning_skips_clusters(self):
+        """Test that tight clusters are skipped as a whole."""
+        vectors = self.clustered_vecs(500, n_centers=10, spread=0.3)
+        full, pruned = Instrumentation(), Instrumentation()
+        for cluster_pruning, inst in [(False, full), (True, pruned)]:
+            cluster = LinksCluster(0.7, 0.995, 0.999, cluster_pruning=cluster_pruning,
+                                   instrumentation=inst)
+            for vector in vectors:
+                cluster.predict(vector)
+        assert len(cluster.subclusters) > 100
+        assert pruned.counters['similarity_evaluations'] \
+            < full.counters['similarity_evaluations'] / 3
+
+    def test_sparse_matches_dense(self):
+        """Test that sparse input gives the labels of the same vectors densified."""
+        vectors = self.sparse_vecs(300)
+        expected = self.new_cluster().fit_predict(vectors.toarray())
+        cluster = self.new_cluster(sparse_input=True, store_vectors=True)
+        labels = cluster.fit_predict(vectors[:150])
+        labels = np.concatenate([labels, [cluster.predict(vectors[i]) for i in range(150, 300)]])
+        np.testing.assert_array_equal(labels, expected)
+        all_vectors = cluster.get_all_vectors()
+        assert sparse.issparse(all_vectors)
+        assert (all_vectors != vectors).nnz == 0
+        cluster_vectors = cluster.get_cluster_vectors(labels[0])
+        assert sparse.issparse(cluster_vectors)
+        assert cluster_vectors.shape[0] == sum(
+            sc.n_vectors for sc in cluster.cluster_members[labels[0]].values())
+
+    def test_sparse_save_load(self, tmp_path):
+        """Test that sparse models keep predicting the same after a snapshot."""
+        vectors = self.sparse_vecs(200)
+        cluster = self.new_cluster(sparse_input=True, store_vectors=True)
+        cluster.fit_predict(vectors[:100])
+        cluster.save(tmp_path)
+        restored = LinksCluster.load(tmp_path)
+        assert restored.sparse_input
+        assert (restored.get_all_vectors() != vectors[:100]).nnz == 0
+        np.testing.assert_array_equal(restored.fit_predict(vectors[100:]),
+                                      cluster.fit_predict(vectors[100:]))
+
+    def test_sparse_mmap_load_empty_row(self, tmp_path):
+        """Test that an empty row can be stored after a memory-mapped load."""
+        vectors = self.sparse_vecs(50)
+        cluster = self.new_cluster(sparse_input=True, store_vectors=True)
+        cluster.fit_predict(vectors)
+        cluster.save(tmp_path)
+        restored = LinksCluster.load(tmp_path, mmap=True)
+        restored.predict(sparse.csr_matrix((1, self.vector_dim)))
+        restored.predict(vectors[0])
+        stored = restored.get_all_vectors()
+        assert stored.shape == (52, self.vector_dim)
+        assert stored[50].nnz == 0
+        assert (stored[51] != vectors[0]).nnz == 0
+
+    def test_sparse_input_needs_sparse_model(self):
+        """Test that sparse vectors are refused by dense models and vice versa options."""
+        with pytest.raises(TypeError):
+            self.cluster.predict(self.sparse_vecs(1))
+        with pytest.raises(ValueError):
+            self.new_cluster(sparse_input=True, cluster_pruning=True)
+
+    def test_fit_stream_memmap(self, tmp_path):
+        """Test that streaming a .npy file labels like a plain loop and reports progress."""
+        vectors = self.clustered_vecs(300, spread=1.0)
+        np.save(tmp_path / 'vectors.npy', vectors)
+        reports = []
+        cluster = LinksCluster(0.3, 0.6, 0.8)
+        output = cluster.fit_stream(tmp_path / 'vectors.npy', chunk_size=64,
+                                    output=tmp_path / 'labels.npy',
+                                    progress=lambda *report: reports.append(report))
+        reference = LinksCluster(0.3, 0.6, 0.8)
+        expected = [reference.predict(vector) for vector in vectors]
+        np.testing.assert_array_equal(output, expected)
+        np.testing.assert_array_equal(np.load(tmp_path / 'labels.npy'), expected)
+        assert [report[:2] for report in reports] == \
+            [(64, 300), (128, 300), (192, 300), (256, 300), (300, 300)]
+        assert all(report[2] > 0 for report in reports)
+
+    def test_fit_stream_iterator(self):
+        """Test that an iterator of vectors and arrays is rechunked without changing labels."""
+        vectors = self.clustered_vecs(300, spread=1.0)
+        source = iter([vectors[:50]] + list(vectors[50:150]) + [vectors[150:300]])
+        labels = LinksCluster(0.3, 0.6, 0.8).fit_stream(source, chunk_size=32)
+        np.testing.assert_array_equal(labels, LinksCluster(0.3, 0.6, 0.8).fit_predict(vectors))
+        sparse_vectors = self.sparse_vecs(100)
+        np.testing.assert_array_equal(
+            self.new_cluster(sparse_input=True).fit_stream(sparse_vectors, chunk_size=16),
+            self.new_cluster(sparse_input=True).fit_predict(sparse_vectors))
+        output = np.empty(len(vectors), dtype=np.int64)
+        LinksCluster(0.3, 0.6, 0.8).fit_stream(iter(vectors), output=output)
+        np.testing.assert_array_equal(output, labels)
+
+    def test_fit_stream_reused_buffer(self):
+        """Test that a reader refilling one buffer for every chunk labels like fit_predict."""
+        vectors = self.clustered_vecs(400, spread=1.0)
+
+        def reader():
+            buffer = np.empty((50, self.vector_dim))
+            for start in range(0, len(vectors), 50):
+                buffer[:] = vectors[start:start + 50]
+                yield buffer
+
+        np.testing.assert_array_equal(LinksCluster(0.3, 0.6, 0.8).fit_stream(reader()),
+                                      LinksCluster(0.3, 0.6, 0.8).fit_predict(vectors))
+
+    def test_fit_stream_unsized_source_to_path(self, tmp_path):
+        """Test that a path output with a source of unknown length is refused up front."""
+        vectors = self.clustered_vecs(10)
+        with pytest.raises(ValueError, match="known length"):
+            LinksCluster(0.3, 0.6, 0.8).fit_stream(iter(vectors), output=tmp_path / 'labels.npy')
+        assert not os.path.exists(tmp_path / 'labels.npy')
+
+    def test_fit_stream_resume(self, tmp_path):
+        """Test that a resumed stream gives the labels of an uninterrupted one."""
+        vectors = self.clustered_vecs(400, spread=1.0)
+        np.save(tmp_path / 'vectors.npy', vectors)
+        expected = LinksCluster(0.3, 0.6, 0.8).fit_predict(vectors)
+
+        def crash(n_done, n_total, rate):
+            if n_done >= 250:
+                raise KeyboardInterrupt
+
+        with pytest.raises(KeyboardInterrupt):
+            LinksCluster(0.3, 0.6, 0.8).fit_stream(
+                tmp_path / 'vectors.npy', chunk_size=50, output=tmp_path / 'labels.npy',
+                checkpoint_dir=tmp_path / 'checkpoints', checkpoint_every=100, progress=crash)
+        cluster, position = LinksCluster.from_checkpoint(tmp_path / 'checkpoints')
+        assert position == 200
+        assert len([name for name in os.listdir(tmp_path / 'checkpoints')
+                    if name.startswith('model-')]) == 1
+        output = cluster.fit_stream(tmp_path / 'vectors.npy', chunk_size=50,
+                                    output=tmp_path / 'labels.npy', start=position)
+        np.testing.assert_array_equal(output, expected)
+
+    def test_freeze_classify(self):
+        """Test that a frozen model finds the cluster of the nearest centroid without changes."""
+        vectors = self.clustered_vecs(400, spread=1.0)
+        cluster = LinksCluster(0.3, 0.6, 0.8)
+        cluster.fit_predict(vectors[:300])
+        frozen = cluster.freeze()
+        assert isinstance(frozen, FrozenLinksCluster)
+        assert len(frozen) == len(cluster.cluster_members)
+        matrix = cluster.centroid_matrix
+        expected = [matrix.cluster_ids[matrix.nearest(vector)] for vector in vectors[300:]]
+        np.testing.assert_array_equal(frozen.classify(vectors[300:], chunk_size=32), expected)
+        cluster.fit_predict(vectors[300:])
+        np.testing.assert_array_equal(frozen.classify(vectors[300:]), expected)
+        with pytest.raises(ValueError):
+            frozen.centroids[0] = 0.0
+        with pytest.raises(ValueError):
+            frozen.classify(vectors[0])
+
+    def test_freeze_classify_topk(self):
+        """Test that top-k clusters are distinct, ordered, and led by classify."""
+        vectors = self.clustered_vecs(300, spread=1.0)
+        cluster = LinksCluster(0.3, 0.6, 0.8)
+        cluster.fit_predict(vectors[:200])
+        frozen = cluster.freeze()
+        labels, sims = frozen.classify_topk(vectors[200:], 3, chunk_size=64)
+        assert labels.shape == sims.shape == (100, 3)
+        np.testing.assert_array_equal(labels[:, 0], frozen.classify(vectors[200:]))
+        assert (np.diff(sims, axis=1) <= 0).all()
+        assert all(len(set(row)) == 3 for row in labels.tolist())
+        for vector, row_labels, row_sims in zip(vectors[200:], labels, sims):
+            for label, sim in zip(row_labels, row_sims):
+                best = max(1.0 - cosine(vector, sc.centroid)
+                           for sc in cluster.cluster_members[label].values())
+                assert sim == pytest.approx(best)
+        all_labels, _ = frozen.classify_topk(vectors[200:], 1000)
+        assert all_labels.shape == (100, len(frozen))
+
+    def test_freeze_threads(self):
+        """Test that threads classifying at once get the single-threaded labels."""
+        vectors = self.clustered_vecs(2000, spread=1.0)
+        cluster = LinksCluster(0.3, 0.6, 0.8)
+        cluster.fit_predict(vectors[:500])
+        frozen = cluster.freeze()
+        expected = frozen.classify(vectors)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda chunk: frozen.classify(chunk, chunk_size=50),
+                                        np.array_split(vectors, 16)))
+        np.testing.assert_array_equal(np.concatenate(results), expected)
+
+    def test_freeze_sparse(self):
+        """Test that sparse models freeze into a classifier of sparse rows."""
+        vectors = self.sparse_vecs(200)
+        cluster = self.new_cluster(sparse_input=True)
+        cluster.fit_predict(vectors[:150])
+        frozen = cluster.freeze()
+        dense_frozen = self.new_cluster()
+        dense_frozen.fit_predict(vectors[:150].toarray())
+        np.testing.assert_array_equal(frozen.classify(vectors[150:]),
+                                      dense_frozen.freeze().classify(vectors[150:].toarray()))
+
+    @pytest.mark.parametrize('sparse_input', [False, True])
+    def test_frozen_load_snapshot(self, tmp_path, sparse_input):
+        """Test that a snapshot opened read-only classifies like the frozen live model."""
+        if sparse_input:
+            vectors = self.sparse_vecs(300)
+            cluster = self.new_cluster(sparse_input=True)
+        else:
+            vectors = self.clustered_vecs(300, spread=1.0)
+            cluster = LinksCluster(0.3, 0.6, 0.8)
+        cluster.fit_predict(vectors[:200])
+        cluster.save(tmp_path)
+        frozen = FrozenLinksCluster.load(tmp_path)
+        expected = cluster.freeze()
+        if not sparse_input:
+            assert isinstance(frozen.centroids, np.memmap)  # Used in place, not copied
+        np.testing.assert_array_equal(frozen.classify(vectors[200:]),
+                                      expected.classify(vectors[200:]))
+        np.testing.assert_allclose(frozen.classify_topk(vectors[200:], 3)[1],
+                                   expected.classify_topk(vectors[200:], 3)[1])
+        os.remove(tmp_path / 'centroid_norms.npy')  # Snapshots saved before norms were
+        np.testing.assert_array_equal(FrozenLinksCluster.load(tmp_path).classify(vectors[200:]),
+                                      expected.classify(vectors[200:]))
+
+    def test_sim_threshold_vectorized(self):
+        """Test that array arguments give the scalar thresholds elementwise."""
+        counts = np.array([1, 2, 7, 100, 2 ** 20])
+        thresholds = self.cluster.sim_threshold(counts, 3)
+        assert thresholds.shape == counts.shape
+        for count, threshold in zip(counts.tolist(), thresholds):
+            assert threshold == self.cluster.sim_threshold(count, 3)
+
+    def test_cosine_similarities_match_scipy(self):
+        """Test that batched similarities agree with scipy cosine."""
+        vectors = self.clustered_vecs(20)
+        subclusters = [Subcluster(vector) for vector in vectors[1:]]
+        sims = LinksCluster._cosine_similarities(vectors[0], subclusters)
+        expected = [1.0 - cosine(vectors[0], vector) for vector in vectors[1:]]
+        np.testing.assert_allclose(sims, expected, rtol=0, atol=1e-12)
+
     def test_sim_threshold_limit(self):
         """Test that the limit for large k is near 1.0."""
         large_k = 2 ** 25
         thresh = self.cluster.sim_threshold(large_k, large_k)
         assert np.abs(thresh - 1.0) < 1.0e-6
 
+    def cli_args(self, *args):
+        """Command line arguments with the test thresholds."""
+        return [*args,
+                '--cluster-similarity-threshold', '0.3',
+                '--subcluster-similarity-threshold', '0.6',
+                '--pair-similarity-maximum', '0.8']
+
+    def test_cli_npy(self, tmp_path, capsys):
+        """Test that the command line labels a .npy file like fit_predict and summarizes."""
+        vectors = self.clustered_vecs(300, spread=1.0)
+        np.save(tmp_path / 'vectors.npy', vectors)
+        assert main(self.cli_args(str(tmp_path / 'vectors.npy'), '--chunk-size', '64')) == 0
+        out, err = capsys.readouterr()
+        expected = LinksCluster(0.3, 0.6, 0.8).fit_predict(vectors)
+        np.testing.assert_array_equal([int(line) for line in out.split()], expected)
+        assert 'vectors: 300' in err
+        assert f'clusters: {len(set(expected))}' in err
+        assert 'update_cluster' in err
+
+    def test_cli_stdin_profile(self, tmp_path, monkeypatch, capsys):
+        """Test raw float32 rows on stdin, .npy output and the profile report."""
+        vectors = self.clustered_vecs(300, spread=1.0).astype(np.float32)
+        monkeypatch.setattr('sys.stdin', io.TextIOWrapper(io.BytesIO(vectors.tobytes())))
+        assert main(self.cli_args('-', '--dim', str(self.vector_dim), '--chunk-size', '100',
+                                  '--output', str(tmp_path / 'labels.npy'),
+                                  '--profile', str(tmp_path / 'profile'))) == 0
+        np.testing.assert_array_equal(np.load(tmp_path / 'labels.npy'),
+                                      LinksCluster(0.3, 0.6, 0.8).fit_predict(vectors))
+        assert 'cumulative' in capsys.readouterr().err
+        assert pstats.Stats(str(tmp_path / 'profile')).total_calls > 0
+        monkeypatch.setattr('sys.stdin', io.TextIOWrapper(io.BytesIO(vectors.tobytes()[:-2])))
+        with pytest.raises(ValueError):
+            main(self.cli_args('-', '--dim', str(self.vector_dim), '--output',
+                               str(tmp_path / 'labels.txt')))
+        with pytest.raises(ValueError):
+            main(self.cli_args('-'))
+
 
 class TestSubcluster:
     """Tests for Subcluster class."""
@@ -240,6 +970,71 @@ class TestSubcluster:
         assert self.subcluster.n_vectors == 2
         assert len(self.subcluster.input_vectors) == 2
 
+    def test_merge_shared_arena_moves_ids_only(self):
+        """Test that merging subclusters of one arena copies no vectors."""
+        arena = VectorArena()
+        sc1 = Subcluster(self.random_vec(), store_vectors=True, arena=arena)
+        sc2 = Subcluster(self.random_vec(), store_vectors=True, arena=arena)
+        sc2.add(self.random_vec())
+        sc1.merge(sc2)
+        assert len(arena) == 3
+        assert list(sc1.vector_ids) == [0, 1, 2]
+        np.testing.assert_array_equal(sc1.input_vectors, arena.view())
+
+    def test_arena_chunks(self):
+        """Test that vectors are found across chunk boundaries."""
+        arena = VectorArena(chunk_size=8)
+        vectors = np.random.random((50, self.vector_dim))
+        for vector in vectors:
+            arena.append(vector)
+        assert len(arena.chunks) > 1
+        assert max(len(chunk) for chunk in arena.chunks) == 8
+        vector_ids = [49, 0, 17, 3, 31]
+        np.testing.assert_array_equal(arena.take(vector_ids), vectors[vector_ids])
+        np.testing.assert_array_equal(arena.view(), vectors)
+
+    def test_compensated_float32_drift(self):
+        """Test that compensated float32 updates track the float64 mean over a long stream."""
+        vectors = np.random.random((20000, 16)) + 5.0
+        expected_centroid = vectors.mean(axis=0)
+        errors = {}
+        for compensated in (False, True):
+            subcluster = Subcluster(vectors[0].astype(np.float32), compensated=compensated)
+            for vector in vectors[1:].astype(np.float32):
+                subcluster.add(vector)
+            assert subcluster.centroid.dtype == np.float32
+            errors[compensated] = np.abs(subcluster.centroid - expected_centroid).max()
+        assert errors[True] < 1.0e-6
+        assert errors[True] < errors[False] / 10.0
+
+    def test_compensated_merge(self):
+        """Test that merging compensated subclusters gives the weighted mean."""
+        vectors = np.random.random((10, self.vector_dim)).astype(np.float32)
+        sc1 = Subcluster(vectors[0], compensated=True)
+        sc2 = Subcluster(vectors[5], compensated=True)
+        for i in range(1, 5):
+            sc1.add(vectors[i])
+            sc2.add(vectors[i + 5])
+        sc1.merge(sc2)
+        assert sc1.centroid.dtype == np.float32
+        np.testing.assert_allclose(sc1.centroid - sc1.compensation,
+                                   vectors.astype(np.float64).mean(axis=0), rtol=1.0e-6)
+
+    def test_sparse_centroid_densifies(self):
+        """Test that a sparse centroid turns dense once it is dense enough."""
+        rows = sparse.csr_matrix(np.eye(self.vector_dim)[:self.vector_dim // 2])
+        subcluster = Subcluster(rows[0], store_vectors=True)
+        for i in range(1, self.vector_dim // 4):
+            subcluster.add(rows[i])
+        assert sparse.issparse(subcluster.centroid)
+        for i in range(self.vector_dim // 4, self.vector_dim // 2):
+            subcluster.add(rows[i])
+        assert isinstance(subcluster.centroid, np.ndarray)
+        np.testing.assert_allclose(subcluster.centroid,
+                                   np.asarray(rows.mean(axis=0)).ravel())
+        assert sparse.issparse(subcluster.input_vectors)
+        assert subcluster.input_vectors.shape == rows.shape
+
     def test_merge_connections(self):
         """Test that we can merge subclusters that have external edges."""
         new_vector_1 = self.random_vec()
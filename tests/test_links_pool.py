@@ -0,0 +1,164 @@
+"""Tests for LinksClusterPool."""
+# pylint: disable=W0201
+
+import time
+
+import numpy as np
+import pytest
+
+from links_cluster import HyperplaneLSHIndex, Instrumentation, LinksCluster
+from links_pool import LinksClusterPool, _SessionWorker, fit_shards, rand_index, route
+
+
+class TestLinksClusterPool:
+    """Tests for LinksClusterPool class."""
+    def setup_method(self):
+        """Setup for tests."""
+        self.thresholds = (0.3, 0.6, 0.8)
+        self.vector_dim = 32
+        rng = np.random.default_rng(0)
+        centers = rng.normal(size=(4, self.vector_dim))
+        self.session_vectors = {
+            f'session-{i}': centers[rng.integers(4, size=60)]
+            + rng.normal(size=(60, self.vector_dim))
+            for i in range(5)}
+
+    def expected_labels(self, session_id):
+        """Labels of a session clustered in this process."""
+        return LinksCluster(*self.thresholds).fit_predict(self.session_vectors[session_id])
+
+    def test_route_is_stable(self):
+        """Test that routing depends only on the session id."""
+        assert route('session-1', 4) == route('session-1', 4)
+        assert {route(f'session-{i}', 3) for i in range(30)} == {0, 1, 2}
+
+    def test_predict_many_matches_local(self):
+        """Test that pooled sessions give the same labels as local models."""
+        with LinksClusterPool(*self.thresholds, n_workers=2, buffer_size=4096) as pool:
+            results = pool.predict_many(self.session_vectors)
+            assert sorted(pool.sessions()) == sorted(self.session_vectors)
+        for session_id, labels in results.items():
+            np.testing.assert_array_equal(labels, self.expected_labels(session_id))
+
+    def test_predict_in_order(self):
+        """Test that single-vector requests continue the same session."""
+        vectors = self.session_vectors['session-0']
+        with LinksClusterPool(*self.thresholds, n_workers=2) as pool:
+            labels = [pool.predict('session-0', vector) for vector in vectors[:20]]
+            labels += list(pool.predict_batch('session-0', vectors[20:]))
+        np.testing.assert_array_equal(labels, self.expected_labels('session-0'))
+
+    def test_small_rows_fit_label_buffer(self):
+        """Test that batches are split so their labels fit the output buffer."""
+        vectors = np.random.default_rng(0).random((2000, 1))
+        with LinksClusterPool(*self.thresholds, n_workers=1, buffer_size=4096,
+                              dtype=np.float32) as pool:
+            labels = pool.predict_batch('session-0', vectors)
+        np.testing.assert_array_equal(
+            labels, LinksCluster(*self.thresholds, dtype=np.float32).fit_predict(vectors))
+
+    def test_oversized_rows_keep_workers_in_step(self):
+        """Test that rows larger than the buffer are refused without desynchronizing workers."""
+        with LinksClusterPool(*self.thresholds, n_workers=2, buffer_size=512) as pool:
+            with pytest.raises(ValueError):
+                pool.predict_many({'session-0': self.session_vectors['session-0'][:5],
+                                   'session-1': np.ones((3, 100))})
+            labels = pool.predict_batch('session-2', self.session_vectors['session-2'][:3])
+            np.testing.assert_array_equal(labels, self.expected_labels('session-2')[:3])
+            assert sorted(pool.sessions()) == ['session-2']
+
+    def test_evict_and_restore(self, tmp_path):
+        """Test that evicted sessions are restored from their snapshots."""
+        vectors = self.session_vectors['session-3']
+        with LinksClusterPool(*self.thresholds, n_workers=2,
+                              snapshot_dir=str(tmp_path)) as pool:
+            first = pool.predict_batch('session-3', vectors[:30])
+            assert pool.evict_idle(0.0) == ['session-3']
+            assert pool.sessions() == []
+            second = pool.predict_batch('session-3', vectors[30:])
+        np.testing.assert_array_equal(np.concatenate([first, second]),
+                                      self.expected_labels('session-3'))
+
+    def test_sessions_get_own_kwargs(self, tmp_path):
+        """Test that sessions of one worker don't share the index, also after a restore."""
+        template = HyperplaneLSHIndex(seed=0)
+        worker = _SessionWorker(None, bytearray(8), bytearray(8), self.thresholds,
+                                {'index': template, 'instrumentation': Instrumentation()},
+                                str(tmp_path), None)
+        labels = {session_id: worker.session(session_id).predict_batch(
+            self.session_vectors[session_id][:30]) for session_id in ('session-0', 'session-1')}
+        first, second = worker.sessions['session-0'], worker.sessions['session-1']
+        assert first.centroid_matrix.index is not second.centroid_matrix.index
+        assert template not in (first.centroid_matrix.index, second.centroid_matrix.index)
+        assert first.instrumentation is not second.instrumentation
+        worker.evict(-1.0)
+        restored = worker.session('session-0')
+        assert restored.centroid_matrix.index is not None
+        assert restored.instrumentation is not None
+        labels['session-0'] = np.concatenate([labels['session-0'], restored.predict_batch(
+            self.session_vectors['session-0'][30:])])
+        expected = LinksCluster(*self.thresholds, index=HyperplaneLSHIndex(seed=0)).fit_predict(
+            self.session_vectors['session-0'])
+        np.testing.assert_array_equal(labels['session-0'], expected)
+
+    def test_idle_timeout_with_busy_session(self, tmp_path):
+        """Test that an idle session is evicted while another on its worker stays busy."""
+        vectors = self.session_vectors['session-0']
+        with LinksClusterPool(*self.thresholds, n_workers=1, snapshot_dir=str(tmp_path),
+                              idle_timeout=0.5) as pool:
+            pool.predict('idle', vectors[0])
+            deadline = time.monotonic() + 3.0
+            while 'idle' in pool.sessions() and time.monotonic() < deadline:
+                pool.predict('busy', vectors[1])
+                time.sleep(0.1)
+            assert pool.sessions() == ['busy']
+
+    def test_evict_needs_snapshot_dir(self):
+        """Test that eviction is refused without a snapshot directory."""
+        with pytest.raises(ValueError):
+            LinksClusterPool(*self.thresholds, n_workers=1, idle_timeout=1.0)
+        with LinksClusterPool(*self.thresholds, n_workers=1) as pool:
+            with pytest.raises(ValueError):
+                pool.evict_idle()
+
+    def test_worker_errors_are_raised(self):
+        """Test that an exception in a worker reaches the caller."""
+        with LinksClusterPool(*self.thresholds, n_workers=1) as pool:
+            pool.predict('session-0', np.ones(self.vector_dim))
+            with pytest.raises(ValueError):
+                pool.predict('session-0', np.ones(self.vector_dim + 1))
+
+
+class TestFitShards:
+    """Tests for fit_shards and rand_index."""
+    def setup_method(self):
+        """Setup for tests."""
+        self.thresholds = (0.3, 0.6, 0.8)
+        rng = np.random.default_rng(0)
+        centers = rng.normal(size=(4, 32))
+        self.vectors = centers[rng.integers(4, size=400)] + 0.5 * rng.normal(size=(400, 32))
+
+    def test_fit_shards_matches_local_merge(self, tmp_path):
+        """Test that shards trained in workers merge like shards trained here."""
+        np.save(tmp_path / 'shard.npy', self.vectors[200:])
+        merged = fit_shards([self.vectors[:200], str(tmp_path / 'shard.npy')],
+                            *self.thresholds, n_workers=2, track_labels=True)
+        local = [LinksCluster(*self.thresholds, track_labels=True) for _ in range(2)]
+        local[0].fit_predict(self.vectors[:200])
+        local[1].fit_predict(self.vectors[200:])
+        expected = LinksCluster.merge_models(*local).point_labels()
+        np.testing.assert_array_equal(merged.point_labels(), expected)
+        sequential = LinksCluster(*self.thresholds, track_labels=True)
+        sequential.fit_predict(self.vectors)
+        assert rand_index(sequential.point_labels(), merged.point_labels()) > 0.95
+
+    def test_rand_index(self):
+        """Test the rand index against a count over all pairs."""
+        labels_a = np.array([0, 0, 1, 1, 2])
+        labels_b = np.array([5, 5, 5, 7, 7])
+        agree = sum((labels_a[i] == labels_a[j]) == (labels_b[i] == labels_b[j])
+                    for i in range(5) for j in range(i + 1, 5))
+        assert rand_index(labels_a, labels_b) == pytest.approx(agree / 10)
+        assert rand_index(labels_a, labels_a + 3) == 1.0
+        with pytest.raises(ValueError):
+            rand_index(labels_a, labels_b[:4])